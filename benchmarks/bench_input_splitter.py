@@ -0,0 +1,39 @@
+"""
+Time pushing large pasted cells through SageInputSplitter.
+
+Run with ``sage -python benchmarks/bench_input_splitter.py``.  The time
+per line should stay flat as the number of lines grows.
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'extensions'))
+from sage_extension import SageInputSplitter
+
+def generated_cell(nlines):
+    """Return ``nlines`` lines of generated Sage-like code."""
+    lines = []
+    i = 0
+    while len(lines) < nlines:
+        lines += ["a%d = %d^2 + 3"%(i, i),
+                  "for j in range(3):",
+                  "    b = [j,",
+                  "         %d]"%i,
+                  "s = '''x",
+                  "y'''",
+                  "f(a%d, b)"%i]
+        i += 1
+    return '\n'.join(lines[:nlines]) + '\n'
+
+def bench(sizes=(1000, 2000, 5000, 10000)):
+    for n in sizes:
+        splitter = SageInputSplitter(input_mode='cell')
+        cell = generated_cell(n)
+        start = time.time()
+        splitter.push(cell)
+        elapsed = time.time() - start
+        print '%6d lines %8.3f s %8.1f us/line'%(n, elapsed, 1e6*elapsed/n)
+
+if __name__ == '__main__':
+    bench()
@@ -2,8 +2,8 @@
 A Sage extension which adds sage-specific features:
 
 * magics
-  - %load: alias to IPython's %run
-  - %attach
+  - %load: preparse and run .sage files (cached on disk), %run anything else
+  - %attach, %detach (attached files are re-run when they change)
   - %mode (like %cython, %maxima, etc.)
 * preparsing of input
   - also make load and attach magics so that the '%' is optional (should we just turn on that optino to IPython?)
@@ -22,41 +22,1380 @@ TODO:
 """
 
 from IPython.core.hooks import TryNext
-from IPython.core.magic import Magics, magics_class, line_magic
+from IPython.core.magic import Magics, magics_class, line_magic, line_cell_magic
 from IPython.core.plugin import Plugin
+from IPython.utils.traitlets import Bool, CaselessStrEnum, Float, Int, List, Unicode
+from IPython.utils.warn import warn
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+import __builtin__
+import copy
+import fnmatch
+import glob
+import hashlib
+import imp
+import itertools
+import json
+import marshal
 import os
+import re
+import resource
 import sys
+import threading
+import time
+import weakref
 import sage
-import sage.all
-from sage.all import quit_sage
-from sage.misc.interpreter import preparser
-from sage.misc.preparser import preparse
+
+
+# On-disk caches:
+#  Data which is expensive to compute at startup but only changes when
+#  the Sage library changes is stored in manifests under DOT_SAGE, keyed
+#  by the Sage version and install location.
+
+def sage_cache_dir(*subdirs):
+    """
+    Return the directory under ``DOT_SAGE`` used for this extension's
+    caches, creating it if necessary.
+    """
+    dot_sage = os.environ.get('DOT_SAGE', os.path.join(os.path.expanduser('~'), '.sage'))
+    path = os.path.join(dot_sage, 'ipython_cache', *subdirs)
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    return path
+
+def sage_version_key():
+    """
+    Return a string identifying the running Sage library; cached data
+    computed from a different library is ignored.
+    """
+    from sage.version import version
+    return '%s %s'%(version, os.path.dirname(os.path.realpath(sage.__file__)))
+
+def load_manifest(name):
+    """
+    Return the data stored in the manifest ``name``, or None if there is
+    no manifest for the running Sage library.
+    """
+    try:
+        with open(os.path.join(sage_cache_dir(), name + '.json')) as f:
+            manifest = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+    if manifest.get('key') != sage_version_key():
+        return None
+    return manifest.get('data')
+
+def save_manifest(name, data):
+    """
+    Store ``data`` in the manifest ``name`` for the running Sage library.
+
+    Failing to write the manifest is not an error; it will just be
+    recomputed next time.
+    """
+    try:
+        filename = os.path.join(sage_cache_dir(), name + '.json')
+        tmp = '%s.%s'%(filename, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump({'key': sage_version_key(), 'data': data}, f)
+        os.rename(tmp, filename)
+    except (IOError, OSError):
+        pass
+
+def all_cmdline_manifest():
+    """
+    Map each name exported by :mod:`sage.all_cmdline` to a module from
+    which it can be imported on its own.
+
+    We prefer the module an object is defined in, then the most deeply
+    nested module holding it, since that pulls in the least of the
+    library.  Names we can't place are imported from
+    :mod:`sage.all_cmdline` itself.
+
+    The names are split into a dictionary ``'lazy'`` of functions,
+    classes and modules, which can be replaced by lazy imports, and a
+    dictionary ``'eager'`` of other objects, such as ``QQ`` or ``pi``,
+    which can't: a proxy isn't the object itself, so for instance
+    ``a.parent() is QQ`` would be False.
+    """
+    import inspect
+    import sage.all_cmdline
+    exported = dict((name, obj) for name, obj in sage.all_cmdline.__dict__.items()
+                    if not name.startswith('_'))
+    manifest = dict.fromkeys(exported, 'sage.all_cmdline')
+    depth = {}
+    for modname, module in sys.modules.items():
+        if module is None or not modname.startswith('sage.') or modname.startswith('sage.all'):
+            continue
+        for name, obj in module.__dict__.items():
+            if name not in exported or exported[name] is not obj:
+                continue
+            if getattr(obj, '__module__', None) == modname:
+                d = sys.maxint
+            else:
+                d = modname.count('.')
+            if d > depth.get(name, -1):
+                depth[name] = d
+                manifest[name] = modname
+    lazy, eager = {}, {}
+    for name, module in manifest.iteritems():
+        obj = exported[name]
+        if (inspect.isroutine(obj) or inspect.isclass(obj) or inspect.ismodule(obj)
+            or type(obj).__name__ == 'cython_function_or_method'):
+            lazy[name] = module
+        else:
+            eager[name] = module
+    return {'lazy': lazy, 'eager': eager}
+
+def interface_manifest():
+    """
+    Map the name of each Sage interface to the attribute of
+    :mod:`sage.interfaces.all` holding it.
+    """
+    import sage.interfaces.all
+    from sage.interfaces.interface import Interface
+    manifest = {}
+    for attr, obj in sorted(sage.interfaces.all.__dict__.items()):
+        if isinstance(obj, Interface):
+            manifest.setdefault(obj.name(), attr)
+    return manifest
+
+def hg_branch_stamp():
+    """
+    Return the modification times of the parts of the Sage library's
+    Mercurial repository which determine its current branch.
+    """
+    root = os.path.join(os.environ.get('SAGE_ROOT', ''), 'devel', 'sage')
+    stamp = []
+    for path in [root, os.path.join(root, '.hg', 'branch'), os.path.join(root, '.hg', 'dirstate')]:
+        try:
+            stamp.append([path, os.lstat(path).st_mtime])
+        except OSError:
+            stamp.append([path, None])
+    return stamp
+
+# Inspector index
+
+class InspectorIndex(object):
+    """
+    A table in an sqlite database mapping the qualified names of
+    classes, functions and modules to their docstrings, sources and
+    argspecs, so that ``?`` and ``??`` don't have to recompute them
+    (which means parsing the source of Cython modules) every time.
+
+    Each entry records the modification time of the file of the module
+    it came from, and is ignored once that file has changed.  Lookups of
+    other objects, such as instances, whose documentation may depend on
+    the object itself, are not cached, and neither are objects that
+    can't be reached under their name from their module (lambdas, nested
+    classes and their methods), since their names aren't unique.
+
+    Like the manifests, the index is for the running Sage library, as
+    given by :func:`sage_version_key`, and is emptied when a different
+    one opens it.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self._db = None
+
+    @property
+    def db(self):
+        if self._db is None:
+            import sqlite3
+            db = sqlite3.connect(self.filename)
+            with db:
+                db.execute('CREATE TABLE IF NOT EXISTS inspector '
+                           '(kind TEXT, name TEXT, mtime REAL, value BLOB, '
+                           'PRIMARY KEY (kind, name))')
+                db.execute('CREATE TABLE IF NOT EXISTS library (key TEXT)')
+                row = db.execute('SELECT key FROM library').fetchone()
+                if row is None or row[0] != sage_version_key():
+                    db.execute('DELETE FROM inspector')
+                    db.execute('DELETE FROM library')
+                    db.execute('INSERT INTO library VALUES (?)', (sage_version_key(),))
+            self._db = db
+        return self._db
+
+    def key(self, obj):
+        """
+        Return the qualified name of ``obj`` and the modification time
+        of the file defining it, or None if ``obj`` shouldn't be cached.
+        """
+        import inspect
+        if inspect.ismodule(obj):
+            module, name = obj, obj.__name__
+        elif inspect.isclass(obj) or inspect.isroutine(obj):
+            name = getattr(obj, '__name__', None)
+            if not isinstance(name, str):
+                return None
+            owner = getattr(obj, '__objclass__', None) or getattr(obj, 'im_class', None)
+            if owner is None and inspect.isroutine(obj):
+                # bound methods of extension types only know their instance
+                instance = getattr(obj, '__self__', None)
+                if instance is not None and not inspect.ismodule(instance):
+                    owner = instance if inspect.isclass(instance) else type(instance)
+            if owner is not None:
+                # im_class is the class the method was looked up on, so
+                # key on the class whose body actually defines it
+                for cls in inspect.getmro(owner):
+                    if name in getattr(cls, '__dict__', {}):
+                        key = self.key(cls)
+                        if key is None:
+                            return None
+                        return '%s.%s'%(key[0], name), key[1]
+                return None
+            module = sys.modules.get(getattr(obj, '__module__', None))
+            if module is None or getattr(module, name, None) is not obj:
+                return None
+            name = '%s.%s'%(module.__name__, name)
+        else:
+            return None
+        try:
+            return name, os.path.getmtime(module.__file__)
+        except (AttributeError, TypeError, OSError):
+            return None
+
+    def cached(self, kind, func):
+        """
+        Return a version of ``func`` which looks its result up in the
+        index under ``kind`` first, and stores it there otherwise.
+        """
+        import cPickle
+        import sqlite3
+        def lookup(obj, *args):
+            key = self.key(obj)
+            if key is None:
+                return func(obj, *args)
+            name, mtime = key
+            try:
+                row = self.db.execute('SELECT mtime, value FROM inspector WHERE kind=? AND name=?',
+                                      (kind, name)).fetchone()
+                if row is not None and row[0] == mtime:
+                    return cPickle.loads(str(row[1]))
+            except (sqlite3.Error, cPickle.UnpicklingError):
+                pass
+            value = func(obj, *args)
+            try:
+                with self.db:
+                    self.db.execute('INSERT OR REPLACE INTO inspector VALUES (?, ?, ?, ?)',
+                                    (kind, name, mtime, sqlite3.Binary(cPickle.dumps(value, 2))))
+            except (sqlite3.Error, cPickle.PicklingError, TypeError):
+                pass
+            return value
+        lookup.__name__ = func.__name__
+        lookup.__doc__ = func.__doc__
+        return lookup
+
+# Startup profiling
+
+def current_rss():
+    """
+    Return the resident set size of this process in bytes.
+
+    Where the current value can't be read (i.e., off Linux), return the
+    peak resident set size instead.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (IOError, OSError, IndexError, ValueError):
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss if sys.platform == 'darwin' else rss * 1024
+
+def cpu_time():
+    """Return the user plus system CPU time used by this process."""
+    t = os.times()
+    return t[0] + t[1]
+
+def format_bytes(n):
+    """Format a (possibly negative) number of bytes for humans."""
+    for unit in ['B', 'KB', 'MB']:
+        if abs(n) < 1024:
+            return '%.1f %s'%(n, unit)
+        n /= 1024.
+    return '%.1f GB'%n
+
+class StartupProfiler(object):
+    """
+    Record the wall time, CPU time and RSS change of each named phase of
+    startup, along with the imports done during each phase.
+
+    When disabled, :meth:`phase` does nothing, so the phases can always
+    be marked.
+    """
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.phases = []
+        self._imports = None
+        self._import_depth = 0
+
+    @contextmanager
+    def phase(self, name):
+        if not self.enabled:
+            yield
+            return
+        self._imports = []
+        real_import = __builtin__.__import__
+        __builtin__.__import__ = self._timed_import(real_import)
+        modules = len(sys.modules)
+        wall, cpu, rss = time.time(), cpu_time(), current_rss()
+        try:
+            yield
+        finally:
+            __builtin__.__import__ = real_import
+            self.phases.append({'name': name,
+                                'wall': time.time() - wall,
+                                'cpu': cpu_time() - cpu,
+                                'rss': current_rss() - rss,
+                                'modules': len(sys.modules) - modules,
+                                'imports': sorted(self._imports, key=lambda i: -i['wall'])})
+            self._imports = None
+
+    def _timed_import(self, real_import):
+        """
+        Wrap ``__import__`` so that each outermost import statement
+        which loads new modules is recorded with its wall time.
+        """
+        def timed_import(name, *args, **kwds):
+            if self._import_depth:
+                return real_import(name, *args, **kwds)
+            modules = len(sys.modules)
+            start = time.time()
+            self._import_depth += 1
+            try:
+                return real_import(name, *args, **kwds)
+            finally:
+                self._import_depth -= 1
+                if len(sys.modules) > modules and self._imports is not None:
+                    self._imports.append({'module': name,
+                                          'wall': time.time() - start,
+                                          'modules': len(sys.modules) - modules})
+        return timed_import
+
+    def report(self, filename=None, imports_per_phase=5):
+        """
+        Print the phases sorted by wall time and, if ``filename`` is
+        given, dump the measurements there as JSON.
+        """
+        if not self.enabled:
+            return
+        total = dict((k, sum(p[k] for p in self.phases)) for k in ('wall', 'cpu', 'rss', 'modules'))
+        print 'Sage startup profile: %.3f s wall, %.3f s CPU, %s RSS, %d modules'%(
+            total['wall'], total['cpu'], format_bytes(total['rss']), total['modules'])
+        for p in sorted(self.phases, key=lambda p: -p['wall']):
+            print '  %-28s %8.3f s %8.3f s %11s %6d modules'%(
+                p['name'], p['wall'], p['cpu'], format_bytes(p['rss']), p['modules'])
+            for i in p['imports'][:imports_per_phase]:
+                print '      import %-33s %8.3f s %6d modules'%(i['module'], i['wall'], i['modules'])
+        if filename:
+            from sage.version import version
+            with open(filename, 'w') as f:
+                json.dump({'sage_version': version, 'total': total, 'phases': self.phases},
+                          f, indent=1)
+
+def allocated_memory():
+    """
+    Return the number of bytes allocated by Python, if tracemalloc is
+    tracing allocations, and the resident set size otherwise.
+    """
+    try:
+        import tracemalloc
+        if tracemalloc.is_tracing():
+            return tracemalloc.get_traced_memory()[0]
+    except ImportError:
+        pass
+    return current_rss()
+
+def sage_subpackage(filename):
+    """
+    Return the Sage subpackage, such as ``sage.rings``, containing the
+    file ``filename``, or a description of where else it is.
+    """
+    if filename == '~':
+        return '<built-in>'
+    parts = os.path.normpath(filename).split(os.sep)
+    if 'sage' in parts:
+        i = len(parts) - 1 - parts[::-1].index('sage')
+        if i + 2 < len(parts):
+            return 'sage.' + parts[i+1]
+        return 'sage'
+    if filename.startswith('<'):
+        return '<input>'
+    return '<other>'
+
+class StageProfiler(object):
+    """
+    Record the wall time and memory change of each stage of running a
+    cell, as :class:`StartupProfiler` does for the phases of startup.
+    """
+    def __init__(self):
+        self.stages = []
+
+    @contextmanager
+    def stage(self, name):
+        wall, memory = time.time(), allocated_memory()
+        try:
+            yield
+        finally:
+            self.stages.append((name, time.time() - wall, allocated_memory() - memory))
+
+    def report(self):
+        total = sum(wall for name, wall, memory in self.stages)
+        for name, wall, memory in self.stages:
+            print '  %-10s %10.6f s %5.1f%% %11s'%(
+                name, wall, 100*wall/total if total else 0, format_bytes(memory))
+
+# Memory use of each cell
+
+def peak_rss():
+    """
+    Return the peak resident set size of this process in bytes, since
+    it was last reset by :func:`reset_peak_rss`.
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError, ValueError):
+        pass
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+def reset_peak_rss():
+    """
+    Reset the peak resident set size to the current one, where the
+    kernel allows it (Linux 4.0 and later).  Return whether it did.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except (IOError, OSError):
+        return False
+
+class MemoryTracker(object):
+    """
+    Record the resident set size of the process before and after each
+    cell, and its peak while the cell ran; if ``top`` is positive and
+    :mod:`tracemalloc` is available, also record the ``top`` places in
+    the code which allocated the most memory during the cell.
+
+    :meth:`pre_run_code_hook` and :meth:`post_execute` are to be hooked
+    into the shell.
+    """
+    def __init__(self, shell, top=0):
+        self.shell = shell
+        self.enabled = True
+        self.history = []
+        self.top = top
+        self.tracemalloc = None
+        if top > 0:
+            try:
+                import tracemalloc
+            except ImportError:
+                warn('tracemalloc is not available; not recording allocation sites')
+            else:
+                if not tracemalloc.is_tracing():
+                    tracemalloc.start()
+                self.tracemalloc = tracemalloc
+        self._cell = None
+
+    def pre_run_code_hook(self, ip):
+        if self.enabled and self._cell != self.shell.execution_count:
+            self._cell = self.shell.execution_count
+            self._peak_reset = reset_peak_rss()
+            self._peak = peak_rss()
+            self._snapshot = self.tracemalloc.take_snapshot() if self.tracemalloc else None
+            self._before = current_rss()
+        raise TryNext
+
+    def post_execute(self):
+        if self._cell is None:
+            return
+        after = current_rss()
+        peak = peak_rss()
+        if not self._peak_reset and peak <= self._peak:
+            # The peak of the whole session was reached before this cell.
+            peak = None
+        sites = []
+        if self._snapshot is not None:
+            stats = self.tracemalloc.take_snapshot().compare_to(self._snapshot, 'lineno')
+            sites = [(str(stat.traceback), stat.size_diff) for stat in stats[:self.top]]
+        self.history.append({'cell': self._cell, 'before': self._before, 'after': after,
+                             'peak': peak, 'sites': sites})
+        self._cell = None
+        print '[mem %s%s -> %s%s]'%('+' if after >= self._before else '',
+                                    format_bytes(after - self._before), format_bytes(after),
+                                    '' if peak is None else ', peak %s'%(format_bytes(peak),))
+        for site, size in sites:
+            print '    %10s  %s'%(format_bytes(size), site)
+
+class AttachedFile(object):
+    """
+    An attached file, along with what it looked like when it was last run.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.mtime = None
+        self.size = None
+        self.digest = None
+        self.load_time = None
+
+    def changed(self):
+        """
+        Return whether the file has changed since it was last run.
+
+        The file is only read when its mtime or size has changed, and
+        merely touching it doesn't count as a change.  A file which is
+        missing or can't be read hasn't changed.
+        """
+        try:
+            st = os.stat(self.filename)
+        except OSError:
+            return False
+        if (st.st_mtime, st.st_size) == (self.mtime, self.size):
+            return False
+        try:
+            with open(self.filename, 'rb') as f:
+                digest = hashlib.sha1(f.read()).hexdigest()
+        except IOError:
+            return False
+        self.mtime, self.size = st.st_mtime, st.st_size
+        if digest == self.digest:
+            return False
+        self.digest = digest
+        return True
+
+# Watching attached files
+
+class AttachWatcher(object):
+    """
+    Collect the attached files which may have changed, so that the
+    pre-run hook only needs to look at those.
+
+    Subclasses notice changes in the background and call :meth:`mark`.
+    Glob patterns can be watched too, so that files created later which
+    match an attached pattern are noticed, except for files which have
+    been unwatched explicitly.
+    """
+    def __init__(self):
+        self.files = set()
+        self.patterns = []
+        self.detached = set()
+        self._dirty = set()
+        self._lock = threading.Lock()
+
+    def watch(self, filename):
+        with self._lock:
+            self.files.add(filename)
+            self.detached.discard(filename)
+            self._dirty.add(filename)
+        self.watch_directory(os.path.dirname(filename))
+
+    def watch_pattern(self, pattern):
+        with self._lock:
+            self.patterns.append(pattern)
+        directory = os.path.dirname(pattern)
+        for d in glob.glob(directory) if glob.has_magic(directory) else [directory]:
+            self.watch_directory(d)
+
+    def unwatch(self, filename):
+        with self._lock:
+            self.files.discard(filename)
+            self._dirty.discard(filename)
+            if filename in self.patterns:
+                self.patterns.remove(filename)
+            else:
+                self.detached.add(filename)
+
+    def mark(self, path):
+        """
+        Note that ``path`` may have changed, if it is watched.
+        """
+        with self._lock:
+            if path in self.files or (path not in self.detached and
+                                      any(fnmatch.fnmatch(path, p) for p in self.patterns)):
+                self._dirty.add(path)
+
+    def drain(self):
+        """
+        Return the paths which may have changed since the last call.
+        """
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+        return dirty
+
+    def watch_directory(self, directory):
+        raise NotImplementedError
+
+class InotifyAttachWatcher(AttachWatcher):
+    """
+    Watch the directories of attached files with inotify.
+
+    This needs the pyinotify module.
+    """
+    def __init__(self):
+        super(InotifyAttachWatcher, self).__init__()
+        import pyinotify
+        self._mask = pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO | pyinotify.IN_CREATE
+        self._manager = pyinotify.WatchManager()
+        self._notifier = pyinotify.ThreadedNotifier(self._manager,
+                                                    lambda event: self.mark(event.pathname))
+        self._notifier.daemon = True
+        self._directories = set()
+
+    def watch_directory(self, directory):
+        with self._lock:
+            if directory in self._directories:
+                return
+            if not self._directories:
+                self._notifier.start()
+            self._directories.add(directory)
+        self._manager.add_watch(directory, self._mask)
+
+class PollingAttachWatcher(AttachWatcher):
+    """
+    Stat the attached files and glob patterns from a background thread
+    every ``interval`` seconds.
+    """
+    def __init__(self, interval=1.0):
+        super(PollingAttachWatcher, self).__init__()
+        self.interval = interval
+        self._stats = {}
+        self._thread = None
+
+    def watch_directory(self, directory):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='attach watcher')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self.poll()
+
+    def poll(self):
+        with self._lock:
+            paths = set(self.files)
+            patterns = list(self.patterns)
+        for pattern in patterns:
+            paths.update(glob.glob(pattern))
+        for path in paths:
+            try:
+                st = os.stat(path)
+                stat = (st.st_mtime, st.st_size)
+            except OSError:
+                stat = None
+            if self._stats.get(path) != stat:
+                self._stats[path] = stat
+                self.mark(path)
+
+def make_attach_watcher(kind, interval=1.0):
+    """
+    Return an :class:`AttachWatcher` of the given kind, or None for 'none'.
+
+    The kind is one of 'none', 'inotify', 'poll', or 'auto', which
+    uses inotify if pyinotify is installed and polls otherwise.
+    """
+    if kind == 'none':
+        return None
+    if kind in ('auto', 'inotify'):
+        try:
+            return InotifyAttachWatcher()
+        except ImportError:
+            if kind == 'inotify':
+                warn('pyinotify is not installed; polling attached files instead')
+    return PollingAttachWatcher(interval)
+
+# Preparsed .sage files
+
+class PreparsedFileCache(object):
+    """
+    An on-disk cache of the code compiled from preparsed ``.sage`` files.
+
+    Entries are keyed by a hash of the file contents, the version of the
+    preparser and its settings, as given by :func:`preparser_state`.
+    Each entry is the preparsed source, which tracebacks refer to, and
+    its marshalled code object.  Once the cache holds more than
+    ``max_size`` bytes, the least recently used entries are removed.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._version = None
+
+    def preparser_version(self):
+        if self._version is None:
+            import sage.misc.preparser
+            self._version = '%s %s'%(sage_version_key(),
+                                     os.path.getmtime(sage.misc.preparser.__file__))
+        return self._version
+
+    def compile(self, filename):
+        """
+        Return a code object for the preparsed contents of ``filename``.
+        """
+        with open(filename) as f:
+            contents = f.read()
+        key = hashlib.sha1('%s %r\0%s'%(self.preparser_version(), preparser_state(),
+                                         contents)).hexdigest()
+        directory = sage_cache_dir('preparsed')
+        source_file = os.path.join(directory, key + '.py')
+        code_file = os.path.join(directory, key + '.sagec')
+        try:
+            with open(code_file, 'rb') as f:
+                if f.read(4) == imp.get_magic():
+                    code = marshal.load(f)
+                    os.utime(code_file, None)
+                    return code
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            pass
+
+        from sage.misc.preparser import preparse_file
+        source = preparse_file(contents)
+        code = compile(source, source_file, 'exec')
+        try:
+            with open(source_file, 'w') as f:
+                f.write(source)
+            tmp = '%s.%s'%(code_file, os.getpid())
+            with open(tmp, 'wb') as f:
+                f.write(imp.get_magic())
+                marshal.dump(code, f)
+            os.rename(tmp, code_file)
+            self.evict(directory)
+        except (IOError, OSError):
+            pass
+        return code
+
+    def evict(self, directory):
+        """
+        Remove the least recently used entries until the cache fits in
+        ``max_size`` bytes.
+        """
+        entries = {}
+        total = 0
+        for name in os.listdir(directory):
+            key, ext = os.path.splitext(name)
+            try:
+                st = os.stat(os.path.join(directory, name))
+            except OSError:
+                continue
+            size, mtime = entries.get(key, (0, 0))
+            if ext == '.sagec':
+                mtime = st.st_mtime
+            entries[key] = (size + st.st_size, mtime)
+            total += st.st_size
+        for key, (size, mtime) in sorted(entries.items(), key=lambda e: e[1][1]):
+            if total <= self.max_size:
+                break
+            for ext in ('.py', '.sagec'):
+                try:
+                    os.remove(os.path.join(directory, key + ext))
+                except OSError:
+                    pass
+            total -= size
+
+# Memoized cells
+
+def cell_names(tree):
+    """
+    Return the sets of names read and assigned by the statements of the
+    parsed cell ``tree``.  Names are only counted as read if they may be
+    read before the cell assigns them.
+
+    Names whose values the cell may change in place, by assigning to an
+    item or attribute, calling a method or passing them to a function,
+    count as both read and assigned.
+    """
+    import ast
+    def root(node):
+        while isinstance(node, (ast.Attribute, ast.Subscript)):
+            node = node.value
+        return node.id if isinstance(node, ast.Name) else None
+    loaded, stored = set(), set()
+    for statement in tree.body:
+        reads, writes = set(), set()
+        for node in ast.walk(statement):
+            if isinstance(node, ast.Name):
+                (reads if isinstance(node.ctx, ast.Load) else writes).add(node.id)
+            elif isinstance(node, ast.AugAssign) and isinstance(node.target, ast.Name):
+                reads.add(node.target.id)
+            elif isinstance(node, (ast.Attribute, ast.Subscript)) and not isinstance(node.ctx, ast.Load):
+                writes.add(root(node))
+            elif isinstance(node, ast.Call):
+                # Methods and functions may change their arguments.
+                if isinstance(node.func, ast.Attribute):
+                    writes.add(root(node.func.value))
+                for arg in node.args + [k.value for k in node.keywords] + [node.starargs, node.kwargs]:
+                    writes.add(root(arg))
+            elif isinstance(node, (ast.FunctionDef, ast.ClassDef)):
+                writes.add(node.name)
+            elif isinstance(node, (ast.Import, ast.ImportFrom)):
+                for alias in node.names:
+                    writes.add((alias.asname or alias.name).split('.')[0])
+        writes.discard(None)
+        loaded |= reads - stored
+        stored |= writes
+    return loaded, stored
+
+class MemoCache(object):
+    """
+    An on-disk cache of the variables assigned by cells run with
+    ``%%memo``.
+
+    Entries are keyed by a hash of the preparsed cell and the pickled
+    values of the variables it reads.  Once the cache holds more than
+    ``max_size`` bytes, the least recently used entries are removed.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+
+    def key(self, source, inputs):
+        """
+        Return the key for running ``source`` with the variables in the
+        dictionary ``inputs``, or None if they can't be pickled.
+        """
+        import cPickle
+        import types
+        from sage.misc.lazy_import import LazyImport
+        h = hashlib.sha1(sage_version_key() + '\0' + source)
+        for name, value in sorted(inputs.items()):
+            if isinstance(value, LazyImport):
+                # Only the Sage library is imported lazily.
+                data = 'lazy'
+            elif isinstance(value, types.ModuleType):
+                data = value.__name__
+            elif isinstance(value, types.FunctionType) and value.__module__ == '__main__':
+                # Pickling refers to the function by name, which misses
+                # changes to its definition.
+                data = marshal.dumps(value.func_code)
+            else:
+                try:
+                    data = cPickle.dumps(value, 2)
+                except Exception:
+                    return None
+            h.update('\0%s\0%d\0%s'%(name, len(data), data))
+        return h.hexdigest()
+
+    def load(self, key):
+        """
+        Return the dictionary of variables and the value of the final
+        expression stored under ``key``, or None.
+        """
+        import cPickle
+        filename = os.path.join(sage_cache_dir('memo'), key + '.pickle')
+        try:
+            with open(filename, 'rb') as f:
+                values, modules, result = cPickle.load(f)
+            for name, module in modules.iteritems():
+                __import__(module)
+                values[name] = sys.modules[module]
+            os.utime(filename, None)
+            return values, result
+        except Exception:
+            return None
+
+    def store(self, key, values, result=None):
+        """
+        Store the variables in the dictionary ``values``, and the value
+        ``result`` of the final expression, under ``key``.  Return the
+        names of the variables which can't be pickled; if there are any,
+        nothing is stored, since restoring the others alone would lose
+        part of what the cell did.
+        """
+        import cPickle
+        import types
+        picklable, modules, skipped = {}, {}, []
+        for name, value in values.iteritems():
+            if isinstance(value, types.ModuleType):
+                modules[name] = value.__name__
+                continue
+            if (isinstance(value, (type, types.ClassType, types.FunctionType))
+                and value.__module__ == '__main__'):
+                # These are pickled by reference to the running session.
+                skipped.append(name)
+                continue
+            try:
+                cPickle.dumps(value, 2)
+                picklable[name] = value
+            except Exception:
+                skipped.append(name)
+        try:
+            data = cPickle.dumps((picklable, modules, result), 2)
+        except Exception:
+            skipped.append('the value of the last line')
+        if skipped:
+            return sorted(skipped)
+        directory = sage_cache_dir('memo')
+        filename = os.path.join(directory, key + '.pickle')
+        try:
+            tmp = '%s.%s'%(filename, os.getpid())
+            with open(tmp, 'wb') as f:
+                f.write(data)
+            os.rename(tmp, filename)
+            self.evict(directory)
+        except (IOError, OSError):
+            pass
+        return []
+
+    def evict(self, directory):
+        """
+        Remove the least recently used entries until the cache fits in
+        ``max_size`` bytes.
+        """
+        entries = []
+        total = 0
+        for name in os.listdir(directory):
+            try:
+                st = os.stat(os.path.join(directory, name))
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, name))
+            total += st.st_size
+        for mtime, size, name in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(os.path.join(directory, name))
+            except OSError:
+                pass
+            total -= size
+
+    def clear(self):
+        directory = sage_cache_dir('memo')
+        for name in os.listdir(directory):
+            try:
+                os.remove(os.path.join(directory, name))
+            except OSError:
+                pass
+
+# Background jobs
+
+class BackgroundJob(object):
+    """
+    A cell run in the background by ``%bg``.
+
+    The statements of the cell, compiled to ``code``, run in a copy of
+    the user namespace; if the cell ends with an expression, compiled
+    to ``last``, its value is the result of the job.  Once the job has
+    finished, :class:`JobManager` copies the variables named in
+    ``stored`` and the result into the user namespace.
+    """
+    kind = None
+
+    def __init__(self, number, source, code, last, ns, stored):
+        self.number = number
+        self.source = source
+        self.code = code
+        self.last = last
+        self.ns = ns
+        self.stored = stored
+        self.state = 'running'
+        self.start_time = time.time()
+        self.end_time = None
+        self.values = {}
+        self.result = None
+        self.error = None
+        self.delivered = False
+
+    def run_cell(self):
+        """
+        Run the cell and return the variables it assigned and its result.
+        """
+        ns = self.ns
+        exec self.code in ns
+        result = None if self.last is None else eval(self.last, ns)
+        return dict((name, ns[name]) for name in self.stored if name in ns), result
+
+    def finish(self, values, result, error=None):
+        self.values, self.result, self.error = values, result, error
+        self.end_time = time.time()
+        if self.state == 'running':
+            self.state = 'done' if error is None else 'failed'
+
+    def elapsed(self):
+        return (self.end_time or time.time()) - self.start_time
+
+class ThreadJob(BackgroundJob):
+    """
+    A background job run in a thread of this process.  It shares the
+    GIL with the shell, so it only helps with code which releases it,
+    and it can only be interrupted between Python bytecodes.  The Sage
+    library's interrupt and alarm handling is global to the process, so
+    this is only safe for pure Python code.
+    """
+    kind = 'thread'
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        import traceback
+        try:
+            values, result = self.run_cell()
+        except BaseException:
+            self.finish({}, None, traceback.format_exc())
+        else:
+            self.finish(values, result)
+
+    def wait(self):
+        while self.thread.is_alive():
+            self.thread.join(0.1)
+
+    def kill(self):
+        import ctypes
+        self.state = 'killed'
+        ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_long(self.thread.ident),
+                                                   ctypes.py_object(KeyboardInterrupt))
+
+class ForkJob(BackgroundJob):
+    """
+    A background job run in a forked copy of this process, which sends
+    back the variables the cell assigned, pickled.  Variables which
+    can't be pickled are lost.
+
+    The copy runs in its own process group, so that interrupting the
+    shell doesn't interrupt it, and, as in Sage's own fork helpers, it
+    starts new copies of any interfaces it uses instead of talking to
+    those of the shell.
+    """
+    kind = 'fork'
+
+    def start(self):
+        import cPickle
+        import traceback
+        read_end, write_end = os.pipe()
+        self.pid = os.fork()
+        if self.pid == 0:
+            os.close(read_end)
+            try:
+                try:
+                    os.setpgid(0, 0)
+                    if 'sage.interfaces.quit' in sys.modules:
+                        from sage.interfaces.quit import invalidate_all
+                        invalidate_all()
+                    values, result = self.run_cell()
+                    data = (dict((name, value) for name, value in values.iteritems()
+                                 if self.picklable(value)),
+                            result if self.picklable(result) else None, None)
+                except BaseException:
+                    data = ({}, None, traceback.format_exc())
+                with os.fdopen(write_end, 'wb') as f:
+                    cPickle.dump(data, f, 2)
+            finally:
+                os._exit(0)
+        os.close(write_end)
+        self.thread = threading.Thread(target=self.collect, args=(read_end,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    @staticmethod
+    def picklable(value):
+        import cPickle
+        try:
+            cPickle.dumps(value, 2)
+            return True
+        except Exception:
+            return False
+
+    def collect(self, read_end):
+        import cPickle
+        with os.fdopen(read_end, 'rb') as f:
+            data = f.read()
+        os.waitpid(self.pid, 0)
+        try:
+            self.finish(*cPickle.loads(data))
+        except Exception:
+            self.finish({}, None, 'The job exited without sending back its results')
+
+    def wait(self):
+        while self.thread.is_alive():
+            self.thread.join(0.1)
+
+    def kill(self):
+        import signal
+        self.state = 'killed'
+        try:
+            os.kill(self.pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+class JobManager(object):
+    """
+    The background jobs started by ``%bg``, numbered from 1.
+    """
+    def __init__(self, shell):
+        self.shell = shell
+        self.jobs = OrderedDict()
+
+    def start(self, source, fork=True):
+        """
+        Start running the preparsed cell ``source`` in the background,
+        and return the job.
+        """
+        import ast
+        shell = self.shell
+        cell_name = shell.compile.cache(source)
+        body = shell.compile.ast_parse(source, filename=cell_name).body
+        stored = cell_names(ast.Module(body))[1]
+        last = None
+        if body and isinstance(body[-1], ast.Expr):
+            last = shell.compile(ast.Expression(body.pop().value), cell_name, 'eval')
+        code = shell.compile(ast.Module(body), cell_name, 'exec')
+        number = len(self.jobs) + 1
+        cls = ForkJob if fork else ThreadJob
+        job = self.jobs[number] = cls(number, source, code, last, dict(shell.user_ns), stored)
+        job.start()
+        return job
+
+    def deliver(self):
+        """
+        Copy the variables assigned by the jobs which have finished into
+        the user namespace, and say which jobs finished.
+        """
+        for job in self.jobs.itervalues():
+            if job.delivered or job.end_time is None:
+                continue
+            job.delivered = True
+            if job.state == 'killed':
+                print '[%d] killed after %.3f s'%(job.number, job.elapsed())
+                continue
+            if job.error is not None:
+                print '[%d] failed after %.3f s:'%(job.number, job.elapsed())
+                print job.error
+                continue
+            self.shell.user_ns.update(job.values)
+            names = sorted(job.values)
+            if job.result is not None:
+                name = '_bg%d'%(job.number,)
+                self.shell.user_ns[name] = job.result
+                names.append(name)
+            print '[%d] done in %.3f s%s'%(job.number, job.elapsed(),
+                                           ': ' + ', '.join(names) if names else '')
+
+# Running many cells
+
+class BufferedHistory(object):
+    """
+    A context manager which groups the history database writes of the
+    cells run by a magic (such as %iload) into one transaction per
+    ``cells`` cells, written at least every ``seconds`` seconds.
+
+    It also keeps the execution counts right: the magic's own input was
+    stored under the current count, so the cells it runs start at the
+    next one, and once the magic returns the shell increments the count
+    past the last of them.
+    """
+    def __init__(self, shell, cells=100, seconds=5.0):
+        self.shell = shell
+        self.cells = cells
+        self.seconds = seconds
+
+    def __enter__(self):
+        history = self.shell.history_manager
+        self._cache_size = history.db_cache_size
+        history.db_cache_size = max(self.cells, self._cache_size)
+        self._flushed = time.time()
+        self.shell.execution_count += 1
+        return self
+
+    def tick(self):
+        """
+        Call after running each cell, to write the history if it has
+        been buffered for long enough.
+        """
+        if time.time() - self._flushed >= self.seconds:
+            self.flush()
+
+    def flush(self):
+        history = self.shell.history_manager
+        if history.save_thread is not None:
+            history.save_flag.set()
+        else:
+            history.writeout_cache()
+        self._flushed = time.time()
+
+    def __exit__(self, *exc_info):
+        self.shell.history_manager.db_cache_size = self._cache_size
+        self.flush()
+        self.shell.execution_count -= 1
 
 @magics_class
 class SageMagics(Magics):
     def __init__(self, *a, **kw):
         super(SageMagics, self).__init__(*a, **kw)
-        self.attach = []
+        self.attached = OrderedDict()
+        self.attach_patterns = []
+        self.detached = set()
+        self.watcher = None
+        self.preparsed_cache = None
+        self.history_batch_cells = 100
+        self.history_batch_seconds = 5.0
         self.ipython_prun = self.shell.magics_manager.magics['line']['prun']
+        self.interface_pool = None
+        self.memory_tracker = None
+        self.memo_cache = None
+        self.job_manager = JobManager(self.shell)
 
     @line_magic
-    def attach(self, filename=''):
-        r"""%attach => run the code each time before starting up.
+    def attach(self, s=''):
+        r"""%attach FILE => run FILE before each command whenever it has changed.
+
+        FILE may be a glob pattern, in which case files created later
+        which match it are attached too.
+
+        %attach --list => list the attached files.
         """
+        opts, filename = self.parse_options(s, '', 'list')
+        if 'list' in opts:
+            for f in self.attached.itervalues():
+                if f.load_time is None:
+                    print '%s (not loaded yet)'%(f.filename,)
+                else:
+                    print '%s (last loaded in %.3f s)'%(f.filename, f.load_time)
+            return
+        if not filename.strip():
+            print 'Usage: %attach FILE'
+            return
+        filename = os.path.abspath(os.path.expanduser(filename))
+        if glob.has_magic(filename):
+            self.attach_patterns.append(filename)
+            if self.watcher is not None:
+                self.watcher.watch_pattern(filename)
+            for f in sorted(glob.glob(filename)):
+                if not os.path.isdir(f):
+                    self.attach_file(f)
+        elif os.path.isdir(filename):
+            print '%s is a directory'%(filename,)
+        else:
+            self.attach_file(filename)
+
+    def attach_file(self, filename):
         print 'Attaching %s'%(filename,)
-        self.attach.append(filename)
+        self.detached.discard(filename)
+        self.attached[filename] = AttachedFile(filename)
+        if self.watcher is not None:
+            self.watcher.watch(filename)
+
+    @line_magic
+    def detach(self, filename=''):
+        r"""%detach FILE => stop running an attached FILE (or glob pattern).
+
+        A file detached this way stays detached even if it matches an
+        attached pattern, until it is attached again.
+        """
+        filename = os.path.abspath(os.path.expanduser(filename.strip()))
+        if filename in self.attach_patterns:
+            self.attach_patterns.remove(filename)
+        elif self.attached.pop(filename, None) is None:
+            print '%s is not attached'%(filename,)
+            return
+        else:
+            self.detached.add(filename)
+        if self.watcher is not None:
+            self.watcher.unwatch(filename)
 
     def pre_run_code_hook(self, ip):
-        for f in self.attach:
-            self.shell.run_line_magic('run', f)
+        self.job_manager.deliver()
+        if self.watcher is None:
+            for pattern in self.attach_patterns:
+                for filename in glob.glob(pattern):
+                    if (filename not in self.attached and filename not in self.detached
+                        and not os.path.isdir(filename)):
+                        self.attach_file(filename)
+            candidates = self.attached.values()
+        else:
+            candidates = []
+            for filename in self.watcher.drain():
+                if filename not in self.attached:
+                    if os.path.isdir(filename):
+                        continue
+                    self.attach_file(filename)
+                candidates.append(self.attached[filename])
+        for f in candidates:
+            if f.changed():
+                self.reload_attached(f)
         raise TryNext
 
+    def reload_attached(self, f):
+        start = time.time()
+        self.load_file(f.filename)
+        f.load_time = time.time() - start
+        print 'Loaded %s (%.3f s)'%(f.filename, f.load_time)
+
+    @line_magic
+    def load(self, s=''):
+        r"""%load FILE => run FILE, preparsing it first if it is a .sage file.
+
+        Other files are run with IPython's %run.
+        """
+        self.load_file(s.strip().strip('"\''))
+
+    def load_file(self, filename):
+        if not filename.endswith('.sage'):
+            self.shell.run_line_magic('run', filename)
+            return
+        try:
+            if self.preparsed_cache is None:
+                from sage.misc.preparser import preparse_file
+                with open(filename) as f:
+                    code = compile(preparse_file(f.read()), filename, 'exec')
+            else:
+                code = self.preparsed_cache.compile(filename)
+            exec code in self.shell.user_ns
+        except Exception:
+            self.shell.showtraceback()
+
+    @line_magic
+    def transform_stats(self, s=''):
+        r"""%transform_stats => show the time spent in each input transform.
+
+        %transform_stats on|off => start or stop timing the transforms.
+
+        Options:
+
+        --reset: reset the counters.
+
+        --csv FILE: write the counters to FILE as CSV.
+        """
+        opts, arg = self.parse_options(s, '', 'reset', 'csv=')
+        splitter = self.shell.input_splitter
+        if arg in ('on', 'off'):
+            splitter.instrument = arg == 'on'
+            return
+        stats = sorted(splitter.transform_stats.items(), key=lambda item: -item[1][1])
+        if 'csv' in opts:
+            import csv
+            with open(opts['csv'], 'wb') as f:
+                writer = csv.writer(f)
+                writer.writerow(['transform', 'calls', 'total_seconds', 'max_seconds', 'changed'])
+                for name, (calls, total, longest, changed) in stats:
+                    writer.writerow([name, calls, total, longest, changed])
+        elif 'reset' not in opts:
+            if not splitter.instrument:
+                print 'Transform timing is off; turn it on with %transform_stats on'
+            print '%-28s %9s %10s %10s %10s %9s'%('transform', 'calls', 'total s', 'mean us', 'max ms', 'changed')
+            for name, (calls, total, longest, changed) in stats:
+                print '%-28s %9d %10.3f %10.1f %10.3f %9d'%(
+                    name, calls, total, 1e6*total/calls, 1e3*longest, changed)
+            print 'cache: %d hits, %d misses'%(splitter.cache_hits, splitter.cache_misses)
+            print 'prefilter: %d of %d lines skipped the transforms (%.1f%%)'%(
+                splitter.prefilter_skipped, splitter.prefilter_checked,
+                100*splitter.prefilter_skip_rate())
+        if 'reset' in opts:
+            splitter.reset_stats()
+
     @line_magic
     def iload(self, s):
         """
         A magic command to interactively load a file as in MAGMA.
 
-        :param s: the file to be interactively loaded
+        :param s: the file to be interactively loaded, optionally
+            preceded by ``--batch`` to run the file without waiting for
+            keypresses (see :meth:`iload_batch`), and ``--echo N`` to
+            print every Nth cell run in batch mode
         :type s: string
 
         .. note::
@@ -70,6 +1409,7 @@ class SageMagics(Magics):
             sage: ip.magic_iload('/dev/null')  # not tested: works only in interactive shell
             Interactively loading "/dev/null"  # not tested: works only in interactive shell
         """
+        opts, s = self.parse_options(s, 'be:', 'batch', 'echo=')
         try:
             name = str(eval(s))
         except Exception:
@@ -83,27 +1423,455 @@ class SageMagics(Magics):
 
         shell = self.shell
 
-        #We need to update the execution count so that the history for the
-        #iload command and the history for the first line of the loaded
-        #file are not written to the history database with the same line
-        #number (execution count).  This happens since the execution count
-        #is updated only after the magic command is run.
-        shell.execution_count += 1
+        if 'b' in opts or 'batch' in opts:
+            with self.buffered_history() as history:
+                self.iload_batch(F, echo=int(opts.get('e', opts.get('echo', 0))), history=history)
+            return
 
         print 'Interactively loading "%s"'%name
 
         # The following code is base on IPython's
         # InteractiveShell.interact,
         more = False
-        for line in F.readlines():
-            prompt = shell.prompt_manager.render('in' if not more else 'in2', color=True)
-            raw_input(prompt.encode('utf-8') + line.rstrip())
+        with self.buffered_history() as history:
+            for line in F.readlines():
+                prompt = shell.prompt_manager.render('in' if not more else 'in2', color=True)
+                raw_input(prompt.encode('utf-8') + line.rstrip())
+
+                shell.input_splitter.push(line)
+                more = shell.input_splitter.push_accepts_more()
+                if not more:
+                    source, source_raw = shell.input_splitter.source_raw_reset()
+                    shell.run_cell(source_raw, store_history=True)
+                    history.tick()
+
+    @line_magic
+    def show_full(self, s=''):
+        r"""%show_full OBJ => display OBJ in full, without the time and size
+        limits set on the formatter.
+
+        %show_full => show how many times formatting timed out.
+        """
+        formatter = self.shell.display_formatter.formatters['text/plain']
+        if not s.strip():
+            print 'Formatting timed out %d times'%(getattr(formatter, 'timeouts', 0),)
+            return
+        obj = self.shell.ev(s)
+        if isinstance(formatter, SagePlainTextFormatter):
+            print formatter.format(obj, limits=False)
+        else:
+            print formatter(obj)
+
+    @line_magic
+    def interfaces(self, s=''):
+        r"""%interfaces => show the state of each interface to another
+        program, how long it took to start, and how much memory it uses.
+        """
+        pool = self.interface_pool
+        print '%-20s %-12s %9s %10s'%('interface', 'state', 'start s', 'memory')
+        for name in sorted(pool.interfaces):
+            state = pool.state(name)
+            start = pool.start_times.get(name)
+            rss = process_rss(pool.pid(name)) if state == 'running' else None
+            print '%-20s %-12s %9s %10s'%(name, state,
+                                          '' if start is None else '%.3f'%(start,),
+                                          '' if rss is None else format_bytes(rss))
+            if name in pool.errors:
+                print '    %s: %s'%(type(pool.errors[name]).__name__, pool.errors[name])
+
+    @line_magic
+    def memhistory(self, s=''):
+        r"""%memhistory => show the memory use of each cell since memory
+        tracking was turned on.
+
+        %memhistory on|off => start or stop tracking memory use.
+
+        Options:
+
+        -s KEY: sort the cells by KEY, one of cell (the default),
+        growth, peak or rss.
+
+        -n N: show only the first N cells.
+        """
+        opts, arg = self.parse_options(s, 's:n:')
+        tracker = self.memory_tracker
+        if arg in ('on', 'off'):
+            if tracker is None and arg == 'on':
+                self.enable_memory_tracking()
+            elif tracker is not None:
+                tracker.enabled = arg == 'on'
+            return
+        if tracker is None:
+            print 'Memory tracking is off; turn it on with %memhistory on'
+            return
+        keys = {'cell': lambda h: h['cell'],
+                'growth': lambda h: h['before'] - h['after'],
+                'peak': lambda h: -(h['peak'] or 0),
+                'rss': lambda h: -h['after']}
+        key = opts.get('s', 'cell')
+        if key not in keys:
+            print 'Unknown sort key %r; use one of %s'%(key, ', '.join(sorted(keys)))
+            return
+        history = sorted(tracker.history, key=keys[key])
+        if 'n' in opts:
+            history = history[:int(opts['n'])]
+        print '%6s %11s %11s %11s %11s'%('cell', 'before', 'after', 'growth', 'peak')
+        for h in history:
+            print '%6d %11s %11s %11s %11s'%(
+                h['cell'], format_bytes(h['before']), format_bytes(h['after']),
+                format_bytes(h['after'] - h['before']),
+                '' if h['peak'] is None else format_bytes(h['peak']))
+
+    def enable_memory_tracking(self, top=0):
+        self.memory_tracker = MemoryTracker(self.shell, top)
+        self.shell.set_hook('pre_run_code_hook', self.memory_tracker.pre_run_code_hook)
+        self.shell.register_post_execute(self.memory_tracker.post_execute)
+
+    @line_cell_magic
+    def sageprof(self, line, cell=None):
+        r"""%sageprof CODE => run CODE and show the time and memory spent
+        preparsing, compiling, running and displaying it.
+
+        %%sageprof does the same for the rest of the cell.
+
+        Memory is measured with tracemalloc when it is tracing, and as
+        the change in resident set size otherwise.
+
+        Options:
+
+        -p: profile running the code with cProfile, and show the time
+        spent in each Sage subpackage.
+
+        -n N: show the N most expensive functions (default 20).
+        """
+        import ast
+        opts, code = self.parse_options(line, 'pn:', posix=False)
+        if cell is not None:
+            code = cell
+        shell = self.shell
+        stages = StageProfiler()
+
+        with stages.stage('preparse'):
+            source = self.preparse_cell(code)
+
+        with stages.stage('compile'):
+            cell_name = shell.compile.cache(source)
+            try:
+                body = shell.compile.ast_parse(source, filename=cell_name).body
+                last = None
+                if body and isinstance(body[-1], ast.Expr):
+                    last = shell.compile(ast.Expression(body.pop().value), cell_name, 'eval')
+                code = shell.compile(ast.Module(body), cell_name, 'exec')
+            except (OverflowError, SyntaxError, ValueError, TypeError, MemoryError):
+                shell.showsyntaxerror()
+                return
+
+        profile = None
+        if 'p' in opts:
+            import cProfile
+            profile = cProfile.Profile()
+        result = None
+        with stages.stage('execute'):
+            if profile is not None:
+                profile.enable()
+            try:
+                exec code in shell.user_ns
+                if last is not None:
+                    result = eval(last, shell.user_ns)
+            except Exception:
+                shell.showtraceback()
+            finally:
+                if profile is not None:
+                    profile.disable()
+
+        with stages.stage('display'):
+            if result is not None:
+                text = shell.display_formatter.format(result).get('text/plain')
+        if result is not None:
+            print text
+
+        print 'Stages:'
+        stages.report()
+        if profile is not None:
+            import pstats
+            stats = pstats.Stats(profile)
+            stats.sort_stats('cumulative').print_stats(int(opts.get('n', 20)))
+            totals = {}
+            for (filename, lineno, function), (cc, nc, tt, ct, callers) in stats.stats.iteritems():
+                package = sage_subpackage(filename)
+                totals[package] = totals.get(package, 0) + tt
+            print 'Time by package:'
+            for package, tt in sorted(totals.items(), key=lambda item: -item[1]):
+                print '  %-28s %10.6f s'%(package, tt)
+
+    def preparse_cell(self, cell):
+        """
+        Return ``cell`` run through the shell's input transforms, without
+        using or filling their cache.
+        """
+        splitter = SageInputSplitter()
+        splitter.transforms = self.shell.input_splitter.transforms
+        splitter.stateful_transforms = self.shell.input_splitter.stateful_transforms
+        splitter.cache_size = 0
+        splitter.push(cell)
+        return splitter.source_reset()
+
+    @line_cell_magic
+    def memo(self, line, cell=None):
+        r"""%%memo => run the cell, unless it was run before, here or in an
+        earlier session, with the same values of the variables it reads;
+        then restore the variables it assigned from an on-disk cache, and
+        display the value of its last line again.
+
+        Cells which read or assign variables which can't be pickled,
+        define functions or classes, or delete variables, are not cached
+        and are always run.
+
+        %memo --clear => empty the cache.
+        """
+        import ast
+        opts, arg = self.parse_options(line, '', 'clear')
+        cache = self.memo_cache
+        if cache is None:
+            print 'The memo cache is disabled (SagePlugin.memo_cache_size is 0)'
+            return
+        if 'clear' in opts:
+            cache.clear()
+            return
+        if cell is None:
+            print 'Usage: %%memo, followed by the cell to run'
+            return
+        shell = self.shell
+        source = self.preparse_cell(cell)
+        cell_name = shell.compile.cache(source)
+        try:
+            tree = shell.compile.ast_parse(source, filename=cell_name)
+        except (OverflowError, SyntaxError, ValueError, TypeError, MemoryError):
+            shell.showsyntaxerror()
+            return
+        loaded, stored = cell_names(tree)
+        ns = shell.user_ns
+        key = cache.key(source, dict((name, ns[name]) for name in loaded if name in ns))
+        if key is not None:
+            entry = cache.load(key)
+            if entry is not None:
+                values, result = entry
+                ns.update(values)
+                print 'Restored %s from the memo cache'%(', '.join(sorted(values)) or 'the result',)
+                if result is not None:
+                    shell.displayhook(result)
+                return
+        else:
+            print 'Some inputs of the cell can\'t be pickled; not caching it'
+        body = tree.body
+        last = None
+        if body and isinstance(body[-1], ast.Expr):
+            last = shell.compile(ast.Expression(body.pop().value), cell_name, 'eval')
+        if shell.run_ast_nodes(body, cell_name, 'none'):
+            return
+        result = None
+        if last is not None:
+            try:
+                result = eval(last, ns)
+            except Exception:
+                shell.showtraceback()
+                return
+            shell.displayhook(result)
+        if key is None:
+            return
+        if any(isinstance(node, ast.Delete) for node in ast.walk(tree)):
+            print 'The cell deletes variables; not caching it'
+            return
+        skipped = cache.store(key, dict((name, ns[name]) for name in stored if name in ns), result)
+        if skipped:
+            print 'Not caching the cell, since it assigns %s, which can\'t be cached'%(
+                ', '.join(skipped),)
+
+    @line_cell_magic
+    def bg(self, line, cell=None):
+        r"""%bg CODE => run CODE in the background and return to the prompt.
+
+        %%bg does the same for the rest of the cell.
+
+        The code runs in a forked copy of Sage.  When it has finished,
+        the variables it assigned which can be pickled are copied into
+        the namespace, and the value of a final expression is stored as
+        ``_bgN``, where N is the number of the job; this happens, with a
+        notice, before the next command runs.
+
+        Options:
+
+        --thread: run the code in a thread of this process instead of a
+        forked copy of Sage, so that variables which can't be pickled are
+        copied back too.  Only use this for pure Python code: the Sage
+        library's handling of interrupts and alarms is shared with the
+        shell, and the thread competes with it for the GIL.
+        """
+        opts, code = self.parse_options(line, '', 'thread', posix=False)
+        if cell is not None:
+            code = cell
+        job = self.job_manager.start(self.preparse_cell(code), fork='thread' not in opts)
+        print '[%d] started in a %s'%(job.number, job.kind)
+
+    @line_magic
+    def jobs(self, s=''):
+        r"""%jobs => list the background jobs started with %bg.
+        """
+        for job in self.job_manager.jobs.itervalues():
+            first_line = job.source.strip().split('\n')[0]
+            print '[%d] %-8s %-6s %10.3f s  %s'%(job.number, job.state, job.kind,
+                                                 job.elapsed(), first_line[:50])
+
+    @line_magic
+    def wait(self, s=''):
+        r"""%wait N => wait for the background job N to finish.
+
+        %wait => wait for all the background jobs.
+        """
+        numbers = [int(n) for n in s.split()] or list(self.job_manager.jobs)
+        for n in numbers:
+            job = self.job_manager.jobs.get(n)
+            if job is None:
+                print 'There is no job %d'%(n,)
+            else:
+                job.wait()
+        self.job_manager.deliver()
+
+    @line_magic
+    def kill(self, s=''):
+        r"""%kill N => stop the background job N.
+
+        Jobs run in a thread can only be interrupted between Python
+        bytecodes, so one stuck in a long call into a library finishes
+        that call first.
+        """
+        for n in [int(n) for n in s.split()]:
+            job = self.job_manager.jobs.get(n)
+            if job is None:
+                print 'There is no job %d'%(n,)
+            elif job.end_time is None:
+                job.kill()
+
+    def buffered_history(self):
+        return BufferedHistory(self.shell, self.history_batch_cells, self.history_batch_seconds)
+
+    def iload_batch(self, F, echo=0, chunk_size=1<<16, history=None):
+        """
+        Run the cells in the open file ``F`` as :meth:`iload` does, but
+        without rendering prompts or waiting for keypresses.
+
+        The file is read lazily, about ``chunk_size`` bytes at a time,
+        so arbitrarily long session transcripts can be replayed.  If
+        ``echo`` is positive, every ``echo``-th cell is printed before
+        it is run.  At the end, the number of lines per second is
+        reported.  If ``history`` is a :class:`BufferedHistory`, it is
+        told about each cell run.
+        """
+        shell = self.shell
+        count = [0]
+        def lines():
+            for chunk in iter(lambda: F.readlines(chunk_size), []):
+                for line in chunk:
+                    count[0] += 1
+                    yield line
+        cells = 0
+        start = time.time()
+        for source_raw in self.batch_cells(lines()):
+            cells += 1
+            if echo > 0 and cells % echo == 0:
+                print '[%d] %s'%(cells, source_raw.rstrip())
+            shell.run_cell(source_raw, store_history=True)
+            if history is not None:
+                history.tick()
+        elapsed = time.time() - start
+        print 'Ran %d lines in %d cells in %.3f s (%.0f lines/s)'%(
+            count[0], cells, elapsed, count[0]/elapsed if elapsed else 0)
+
+    def batch_cells(self, lines):
+        r"""
+        Split the lines of input ``lines`` into the cells :meth:`iload`
+        runs them as, and yield the raw source of each cell.
+
+        Lines are pushed to the input splitter one at a time, as when
+        loading interactively, except that once a line leaves a bracket,
+        string or backslash continuation open (in its transformed form),
+        the following lines are collected and pushed together when it is
+        closed, so that long statements aren't compiled again for every
+        line.  If the cell doesn't compile with them, or one of them
+        starts a cell magic, they may not all belong to it, so they are
+        pushed one at a time after all.
 
-            shell.input_splitter.push(line)
-            more = shell.input_splitter.push_accepts_more()
-            if not more:
-                source, source_raw = shell.input_splitter.source_raw_reset()
-                shell.run_cell(source_raw, store_history=True)
+        EXAMPLES::
+
+            sage: from sage.misc.interpreter import get_test_shell
+            sage: shell = get_test_shell()
+            sage: magics = shell.magics_manager.registry['SageMagics']
+            sage: text = '!echo (\nL = [1,\n     2]\n%time f(\ny = 2\n'
+            sage: list(magics.batch_cells(iter(text.splitlines(True))))
+            [u'!echo (\n', u'L = [1,\n     2]\n', u'%time f(\n', u'y = 2\n']
+
+        These are the cells the lines are run as interactively::
+
+            sage: splitter = shell.input_splitter
+            sage: cells = []
+            sage: for line in text.splitlines(True):
+            ....:     _ = splitter.push(line)
+            ....:     if not splitter.push_accepts_more():
+            ....:         cells.append(splitter.source_raw_reset()[1])
+            sage: cells == list(magics.batch_cells(iter(text.splitlines(True))))
+            True
+        """
+        splitter = self.shell.input_splitter
+        lines = iter(lines)
+        queue = deque()
+        block = None
+        pending = []
+        batch = True
+        def compiles(text):
+            try:
+                splitter._compile(u''.join(splitter._buffer) + text, symbol="exec")
+                return True
+            except (SyntaxError, OverflowError, ValueError, TypeError,
+                    MemoryError):
+                return False
+        while True:
+            line = queue.popleft() if queue else next(lines, None)
+            if block is not None:
+                magic = False
+                if line is not None:
+                    pending.append(line)
+                    block.feed(line.rstrip('\n'))
+                    # push() starts a cell magic on any line beginning
+                    # with %%, even in the middle of a cell.
+                    magic = line.startswith('%%')
+                    if not (magic or block.at_boundary()):
+                        continue
+                elif not pending:
+                    block = None
+                    continue
+                text = ''.join(pending)
+                if not magic and compiles(text):
+                    queue.appendleft(text)
+                else:
+                    # Go back to pushing lines one at a time until the
+                    # end of the cell.
+                    queue.extendleft(reversed(pending))
+                    batch = False
+                del pending[:]
+                block = None
+                continue
+            if line is None:
+                break
+            splitter.push(line)
+            if splitter.push_accepts_more():
+                if batch and not splitter._block.at_boundary():
+                    block = copy.copy(splitter._block)
+                continue
+            batch = True
+            yield splitter.source_raw_reset()[1]
+        source, source_raw = splitter.source_raw_reset()
+        if source_raw.strip():
+            yield source_raw
 
     # @line_magic
     # def preparse(self, parameter_s = ''):
@@ -133,7 +1901,29 @@ class SagePlainTextFormatter(PlainTextFormatter):
         [1 0]  [1 0]
         [0 1], [0 1]
         ]
+
+    The output can be limited to a budget, so that accidentally
+    displaying a huge object doesn't freeze the terminal: matrices are
+    cut down to :attr:`max_rows` rows and :attr:`max_cols` columns,
+    lists, tuples, dictionaries and sets to :attr:`max_rows` entries,
+    polynomials to :attr:`max_cols` terms, and strings to
+    :attr:`max_chars` characters, before they are turned into strings.
+    Other objects, such as symbolic expressions, are formatted in full,
+    and any output longer than :attr:`max_chars` characters is then cut
+    off; :attr:`timeout` bounds the time that takes.  A note says what
+    was left out.  A limit of 0 means no limit.
+
+    Formatting can also be given at most :attr:`timeout` seconds.  If it
+    takes longer, only a short summary of the object's type and size is
+    displayed, and ``%show_full _`` displays it in full.  The number of
+    times this has happened is kept in :attr:`timeouts`.
     """
+    max_chars = Int(0, config=True, help="Maximum number of characters of output")
+    max_rows = Int(0, config=True, help="Maximum number of matrix rows or list entries to display")
+    max_cols = Int(0, config=True, help="Maximum number of matrix columns or polynomial terms to display")
+    timeout = Float(0, config=True, help="Maximum number of seconds to spend formatting output")
+    timeouts = 0
+
     def __call__(self, obj):
         r"""
         Computes the format data of ``result``.  If the
@@ -152,14 +1942,537 @@ class SagePlainTextFormatter(PlainTextFormatter):
             sage: shell.displayhook.compute_format_data([a,a])
             {u'text/plain': '[\n[1 0]  [1 0]\n[0 1], [0 1]\n]'}
         """
+        if self.timeout <= 0:
+            return self.format(obj)
+        from sage.misc.misc import alarm, cancel_alarm
+        start = time.time()
+        alarm(self.timeout)
+        try:
+            return self.format(obj)
+        except KeyboardInterrupt:
+            # The alarm is delivered as a KeyboardInterrupt; one that
+            # comes before the time is up was a real Control-C.
+            if time.time() - start < self.timeout:
+                raise
+            self.timeouts += 1
+            return '%s\n(formatting timed out after %g s; %%show_full _ displays it in full)'%(
+                self.summary(obj), self.timeout)
+        finally:
+            cancel_alarm()
+
+    def format(self, obj, limits=True):
+        """
+        Return the plain text form of ``obj``, cut down to the size
+        limits unless ``limits`` is False.
+        """
         import sage
         from sage.misc.displayhook import print_obj
+        if not limits:
+            s = print_obj(obj)
+            return super(SagePlainTextFormatter, self).__call__(obj) if s is False else s
+        note = None
+        if self.max_rows or self.max_cols or self.max_chars:
+            obj, note = self.truncate(obj)
         s = print_obj(obj)
         if s is False:
-            return super(SagePlainTextFormatter, self).__call__(obj)
+            s = super(SagePlainTextFormatter, self).__call__(obj)
+        if self.max_chars and len(s) > self.max_chars:
+            note = note or '%d of %d characters shown'%(self.max_chars, len(s))
+            s = s[:self.max_chars] + '...'
+        if note is not None:
+            s += '\n(%s)'%note
+        return s
+
+    def truncate(self, obj):
+        """
+        Return ``obj`` cut down to :attr:`max_rows`, :attr:`max_cols`
+        and :attr:`max_chars`, along with a note saying what was left
+        out, or None if nothing was.
+        """
+        rows, cols, chars = self.max_rows, self.max_cols, self.max_chars
+        if isinstance(obj, basestring):
+            if chars and len(obj) > chars:
+                return obj[:chars], '%d of %d characters shown'%(chars, len(obj))
+            return obj, None
+        if isinstance(obj, dict):
+            note = None
+            keys = list(obj)
+            if rows and len(keys) > rows:
+                try:
+                    # pretty printing sorts the keys too
+                    keys.sort()
+                except Exception:
+                    pass
+                note = '%d of %d entries shown'%(rows, len(obj))
+                keys = keys[:rows]
+            entries = [(k, self.truncate(obj[k])) for k in keys]
+            if any(n is not None for k, (v, n) in entries):
+                note = note or 'some entries shortened'
+            if note is None:
+                return obj, None
+            return dict((k, v) for k, (v, n) in entries), note
+        if isinstance(obj, (set, frozenset)):
+            if rows and len(obj) > rows:
+                seq = frozenset if isinstance(obj, frozenset) else set
+                return (seq(itertools.islice(obj, rows)),
+                        '%d of %d entries shown'%(rows, len(obj)))
+            return obj, None
+        if isinstance(obj, (list, tuple)):
+            seq = list if isinstance(obj, list) else tuple
+            note = None
+            if rows and len(obj) > rows:
+                note = '%d of %d entries shown'%(rows, len(obj))
+                obj = obj[:rows]
+            entries = [self.truncate(x) for x in obj]
+            if any(n is not None for x, n in entries):
+                note = note or 'some entries shortened'
+                obj = seq(x for x, n in entries)
+            return obj, note
+        if hasattr(obj, 'matrix_from_rows_and_columns'):
+            nrows, ncols = obj.nrows(), obj.ncols()
+            r = min(nrows, rows or nrows)
+            c = min(ncols, cols or ncols)
+            if (r, c) == (nrows, ncols):
+                return obj, None
+            return (obj.matrix_from_rows_and_columns(range(r), range(c)),
+                    'top left %d x %d of a %d x %d matrix shown'%(r, c, nrows, ncols))
+        if cols and hasattr(obj, 'number_of_terms') and hasattr(obj, 'dict'):
+            terms = obj.dict()
+            if len(terms) <= cols:
+                return obj, None
+            leading = sorted(terms.items(), reverse=True)[:cols]
+            return (obj.parent()(dict(leading)),
+                    '%d of %d terms shown'%(cols, len(terms)))
+        return obj, None
+
+    @staticmethod
+    def summary(obj):
+        """
+        Return a short description of the type and size of ``obj``
+        which is cheap to compute.
+        """
+        s = '<%s'%(type(obj).__name__,)
+        try:
+            if hasattr(obj, 'matrix_from_rows_and_columns'):
+                s += ' %d x %d'%(obj.nrows(), obj.ncols())
+            elif isinstance(obj, (list, tuple, dict, set, frozenset)):
+                s += ' of length %d'%(len(obj),)
+            if hasattr(obj, 'parent') and not isinstance(obj, type):
+                s += ' in %s'%(type(obj.parent()).__name__,)
+        except Exception:
+            pass
+        return s + '>'
+
+
+# Interfaces to other programs
+
+def process_rss(pid):
+    """
+    Return the resident set size of the process ``pid`` in bytes, or
+    None if it can't be read.
+    """
+    try:
+        with open('/proc/%d/statm'%(pid,)) as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (IOError, OSError, IndexError, ValueError, TypeError):
+        return None
+
+class InterfacePool(object):
+    """
+    Keeps track of starting the Sage interfaces to other programs, so
+    that some of them can be started before the first prompt rather
+    than when they are first used.
+
+    ``interfaces`` maps the name of each interface to the attribute of
+    :mod:`sage.interfaces.all` holding it, as :func:`interface_manifest`
+    does.
+    """
+    def __init__(self, interfaces):
+        self.interfaces = interfaces
+        self.prestarted = False
+        self.start_times = {}
+        self.errors = {}
+
+    def interface(self, name):
+        import sage.interfaces.all
+        return getattr(sage.interfaces.all, self.interfaces[name])
+
+    def prestart(self, names):
+        """
+        Start the interfaces ``names``, one after the other.
+
+        This isn't done in the background, since starting an interface
+        changes the working directory of the whole process while it
+        spawns the program, which would race with the commands run
+        meanwhile.
+        """
+        for name in names:
+            if name not in self.interfaces:
+                warn('Unknown interface %r; not starting it'%(name,))
+            elif self.state(name) == 'not started':
+                self.start(name)
+                if isinstance(self.errors.get(name), KeyboardInterrupt):
+                    break
+
+    def start(self, name):
+        start = time.time()
+        try:
+            self.interface(name)._start()
+        except BaseException as e:
+            self.errors[name] = e
         else:
-            return s
+            self.start_times[name] = time.time() - start
 
+    def state(self, name):
+        if name in self.errors:
+            return 'failed'
+        if getattr(self.interface(name), '_expect', None) is not None:
+            return 'running'
+        return 'not started'
+
+    def pid(self, name):
+        try:
+            return self.interface(name).pid()
+        except Exception:
+            return None
+
+def quit_interfaces(timeout):
+    """
+    Quit all the running interfaces to other programs at the same time,
+    killing any which haven't quit after ``timeout`` seconds.
+
+    Return a list of ``(name, seconds)`` pairs, slowest first, where
+    ``seconds`` is None for the interfaces which were killed.
+    """
+    import signal
+    if 'sage.interfaces.quit' not in sys.modules:
+        # No interface was ever used.
+        return []
+    from sage.interfaces.quit import expect_objects
+    running = [r() for r in expect_objects]
+    running = [obj for obj in running if obj is not None and getattr(obj, '_expect', None) is not None]
+    times = [None] * len(running)
+    def quit(i):
+        start = time.time()
+        try:
+            running[i].quit(verbose=False)
+        except Exception:
+            pass
+        times[i] = time.time() - start
+    threads = [threading.Thread(target=quit, args=(i,)) for i in range(len(running))]
+    deadline = time.time() + timeout
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join(max(deadline - time.time(), 0))
+    report = []
+    for obj, seconds in zip(running, times):
+        if seconds is None:
+            try:
+                os.kill(obj._expect.pid, signal.SIGKILL)
+            except (AttributeError, OSError):
+                pass
+        report.append((obj.name(), seconds))
+    report.sort(key=lambda (name, seconds): -1 if seconds is None else -seconds)
+    return report
+
+# Tab completion
+
+class CompletionIndex(object):
+    """
+    Faster tab completion for a namespace holding thousands of names.
+
+    :meth:`global_matches` replaces the completer's method of the same
+    name, which scans every name in the namespaces on each TAB, with a
+    binary search in a sorted list of the names.  The list is built in
+    a background thread by :meth:`start` and rebuilt when names are
+    added to or removed from the user namespace.
+
+    :meth:`dir2` replaces :func:`IPython.utils.dir2.dir2` in the
+    completer, remembering the attributes of the objects of each type
+    (and Sage category) so that completing attributes of Sage parents
+    and elements doesn't run ``dir()`` on every TAB.  Classes defined in
+    the session, modules and lazy imports are always looked at afresh.
+    """
+    def __init__(self, shell):
+        self.shell = shell
+        self.names = None
+        self.keys = set()
+        self.attrs = {}
+        from IPython.core import completer
+        self._dir2 = completer.dir2
+
+    def start(self):
+        thread = threading.Thread(target=self.rebuild)
+        thread.daemon = True
+        thread.start()
+
+    def namespace_keys(self):
+        return set(self.shell.user_ns) | set(self.shell.user_global_ns)
+
+    def rebuild(self):
+        import keyword
+        try:
+            keys = self.namespace_keys()
+        except RuntimeError:
+            # The namespace changed while we were reading it.
+            return
+        names = set(keyword.kwlist) | set(__builtin__.__dict__) | keys
+        names.discard('__builtins__')
+        self.keys = keys
+        self.names = sorted(names)
+
+    def post_execute(self):
+        """
+        Forget the names and attributes once names have been added to or
+        removed from the user namespace.
+        """
+        keys = self.namespace_keys()
+        if keys != self.keys:
+            self.names = None
+            self.keys = keys
+            self.attrs.clear()
+
+    def global_matches(self, text):
+        import bisect
+        names = self.names
+        if names is None:
+            self.rebuild()
+            names = self.names
+        matches = []
+        for i in xrange(bisect.bisect_left(names, text), len(names)):
+            if not names[i].startswith(text):
+                break
+            matches.append(names[i])
+        return matches
+
+    def attr_key(self, obj):
+        """
+        Return the key under which the attributes of ``obj`` are
+        remembered, or None if they should not be.
+        """
+        import types
+        from sage.misc.lazy_import import LazyImport
+        cls = type(obj)
+        if (isinstance(obj, (type, types.ClassType, types.ModuleType, types.InstanceType, LazyImport))
+            or cls.__module__ == '__main__'):
+            return None
+        try:
+            category = obj.category() if hasattr(cls, 'category') else None
+            hash(category)
+        except Exception:
+            return None
+        return cls, category
+
+    def dir2(self, obj):
+        key = self.attr_key(obj)
+        if key is None:
+            return self._dir2(obj)
+        words = self.attrs.get(key)
+        if words is None:
+            words = self.attrs[key] = self._dir2(obj)
+        instance_dict = getattr(obj, '__dict__', None)
+        if instance_dict:
+            words = sorted(set(words).union(w for w in instance_dict if isinstance(w, basestring)))
+        return words
+
+# Choosing which results to display
+
+def estimated_size(obj):
+    """
+    Return a cheap estimate of how many entries displaying ``obj``
+    would print: the number of entries of a matrix, the length of a
+    container, and 1 for anything else.
+    """
+    try:
+        if hasattr(obj, 'matrix_from_rows_and_columns'):
+            return obj.nrows() * obj.ncols()
+        if isinstance(obj, (list, tuple, dict, set, frozenset, basestring)):
+            return len(obj)
+        if hasattr(obj, 'number_of_terms'):
+            return obj.number_of_terms()
+    except Exception:
+        pass
+    return 1
+
+class InteractivityFilter(object):
+    """
+    A replacement for :meth:`InteractiveShell.run_ast_nodes` which,
+    when every expression in a cell would be displayed, displays only
+    some of them:
+
+    - with mode 'small', only results whose :func:`estimated_size` is at
+      most ``max_size`` (the result of the last statement is always
+      displayed);
+
+    - with mode 'last_n', only the results of the last ``last_n``
+      expression statements.
+
+    The other expressions are still run; a summary line says how many
+    results were not displayed.
+    """
+    def __init__(self, shell, mode, last_n=1, max_size=100):
+        self.shell = shell
+        self.mode = mode
+        self.last_n = last_n
+        self.max_size = max_size
+        self.run_ast_nodes = shell.run_ast_nodes
+
+    def __call__(self, nodelist, cell_name, interactivity='last_expr'):
+        if interactivity != 'all' or not nodelist:
+            return self.run_ast_nodes(nodelist, cell_name, interactivity)
+        if self.mode == 'last_n':
+            return self.run_last_n(nodelist, cell_name)
+        return self.run_small(nodelist, cell_name)
+
+    def run_last_n(self, nodelist, cell_name):
+        import ast
+        exprs = [i for i, node in enumerate(nodelist) if isinstance(node, ast.Expr)]
+        skipped = max(len(exprs) - self.last_n, 0)
+        split = exprs[skipped] if skipped < len(exprs) else len(nodelist)
+        try:
+            if split and self.run_ast_nodes(nodelist[:split], cell_name, 'none'):
+                return True
+        finally:
+            self.report(skipped)
+        return self.run_ast_nodes(nodelist[split:], cell_name, 'all')
+
+    def run_small(self, nodelist, cell_name):
+        displayhook = sys.displayhook
+        skipped = [0]
+        def small_only(obj):
+            if obj is not None and estimated_size(obj) > self.max_size:
+                skipped[0] += 1
+            else:
+                displayhook(obj)
+        sys.displayhook = small_only
+        try:
+            if len(nodelist) > 1 and self.run_ast_nodes(nodelist[:-1], cell_name, 'all'):
+                return True
+        finally:
+            sys.displayhook = displayhook
+            self.report(skipped[0])
+        return self.run_ast_nodes(nodelist[-1:], cell_name, 'all')
+
+    def report(self, skipped):
+        if skipped:
+            print '(%d result%s not displayed)'%(skipped, '' if skipped == 1 else 's')
+
+# Output history
+
+def estimated_bytes(obj):
+    """
+    Return a rough estimate of the memory used by ``obj`` and its
+    entries, which is cheap to compute.
+    """
+    try:
+        size = sys.getsizeof(obj)
+        if hasattr(obj, 'matrix_from_rows_and_columns'):
+            n = obj.nrows() * obj.ncols()
+            if n:
+                size += n * sys.getsizeof(obj[0, 0])
+        elif isinstance(obj, (list, tuple, set, frozenset, dict)):
+            sample = list(itertools.islice(obj, 100))
+            if sample:
+                size += len(obj) * sum(sys.getsizeof(x) for x in sample) // len(sample)
+        elif hasattr(obj, 'number_of_terms'):
+            size += 64 * obj.number_of_terms()
+        return size
+    except Exception:
+        return 64
+
+class EvictedOutput(object):
+    """
+    What is left in the output history of a result which was evicted
+    from :class:`OutputCache`: a short summary of it and, where the
+    object supports it, a weak reference to it.
+    """
+    def __init__(self, n, obj):
+        self.n = n
+        self.summary = SagePlainTextFormatter.summary(obj)
+        try:
+            self.ref = weakref.ref(obj)
+        except TypeError:
+            self.ref = None
+
+    def value(self):
+        """Return the evicted object if it still exists, and None otherwise."""
+        return None if self.ref is None else self.ref()
+
+    def __repr__(self):
+        return '<Out[%d] evicted from the output cache: %s>'%(self.n, self.summary)
+
+class OutputCache(dict):
+    """
+    A replacement for the output history (``Out`` and ``_oh``) which
+    keeps at most ``max_count`` results, and results taking at most
+    about ``max_bytes`` bytes (as estimated by :func:`estimated_bytes`),
+    evicting the least recently used ones.  A limit of 0 means no limit.
+    The latest result is always kept.
+
+    Evicted results are replaced, in the output history and as ``_N``
+    in the user namespace, by an :class:`EvictedOutput`; looking them up
+    in ``Out`` still gives the object if something else keeps it alive.
+    """
+    def __init__(self, shell, max_count=0, max_bytes=0, items=()):
+        dict.__init__(self)
+        self.shell = shell
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        self.sizes = OrderedDict()
+        self.total = 0
+        for n, obj in sorted(dict(items).items()):
+            self[n] = obj
+
+    @classmethod
+    def install(cls, shell, max_count=0, max_bytes=0):
+        history = shell.history_manager
+        cache = cls(shell, max_count, max_bytes, history.output_hist)
+        history.output_hist = cache
+        shell.user_ns['Out'] = shell.user_ns['_oh'] = cache
+        return cache
+
+    def __setitem__(self, n, obj):
+        self._forget(n)
+        dict.__setitem__(self, n, obj)
+        if not isinstance(obj, EvictedOutput):
+            self.sizes[n] = estimated_bytes(obj)
+            self.total += self.sizes[n]
+            self.evict()
+
+    def __getitem__(self, n):
+        obj = dict.__getitem__(self, n)
+        if n in self.sizes:
+            self.sizes[n] = self.sizes.pop(n)
+        elif isinstance(obj, EvictedOutput) and obj.value() is not None:
+            return obj.value()
+        return obj
+
+    def __delitem__(self, n):
+        self._forget(n)
+        dict.__delitem__(self, n)
+
+    def clear(self):
+        dict.clear(self)
+        self.sizes.clear()
+        self.total = 0
+
+    def _forget(self, n):
+        self.total -= self.sizes.pop(n, 0)
+
+    def evict(self):
+        while len(self.sizes) > 1 and ((self.max_count and len(self.sizes) > self.max_count)
+                                       or (self.max_bytes and self.total > self.max_bytes)):
+            n, size = self.sizes.popitem(last=False)
+            self.total -= size
+            obj = dict.__getitem__(self, n)
+            evicted = EvictedOutput(n, obj)
+            dict.__setitem__(self, n, evicted)
+            name = '_%d'%(n,)
+            if self.shell.user_ns.get(name) is obj:
+                self.shell.user_ns[name] = evicted
+            del obj
 
 # SageInputSplitter:
 #  Hopefully most or all of this code can go away when
@@ -172,9 +2485,103 @@ from IPython.core.inputsplitter import (transform_ipy_prompt, transform_classic_
                                         cast_unicode,
                                         IPythonInputSplitter)
 
+def preparser_state():
+    """
+    Return the settings which change what the Sage preparser does to a
+    line: whether it is on, and the level of implicit multiplication.
+    """
+    import sage.misc.interpreter
+    import sage.misc.preparser
+    return (getattr(sage.misc.interpreter, '_do_preparse', True),
+            getattr(sage.misc.preparser, 'implicit_mul_level', False))
+
+def preparser_quote_state():
+    """
+    Return the string literal, if any, which the Sage preparser has
+    seen opened but not closed on the lines preparsed so far.
+    """
+    import sage.misc.preparser
+    return getattr(sage.misc.preparser, 'quote_state', None)
+
+class BlockTracker(object):
+    """
+    Follow Python source line by line, keeping track of open brackets,
+    strings and backslash continuations, and of the buffer index where
+    the current top-level statement started.
+
+    This lets :class:`SageInputSplitter` find out whether pushed input
+    is complete by compiling only the current statement, rather than
+    everything pushed so far.
+    """
+    _code_re = re.compile(r"""'''|\"\"\"|['"#()\[\]{}]""")
+    _string_end_re = dict((q, re.compile(r'\\.|' + q)) for q in ["'''", '"""', "'", '"'])
+    _clause_re = re.compile(r'(else|elif|except|finally)\b')
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.depth = 0
+        self.quote = None
+        self.continued = False
+        self.lines = 0
+        self.statement_start = 0
+        self.syntax_error = False
+        self._decorator = False
+
+    def at_boundary(self):
+        """
+        Return whether the lines so far end between logical lines.
+        """
+        return not (self.depth or self.quote or self.continued)
+
+    def feed(self, line):
+        if self.at_boundary() and line[:1] not in ' \t#' and line.strip():
+            if not (self._decorator or self._clause_re.match(line)):
+                self.statement_start = self.lines
+            self._decorator = line.startswith('@')
+        self.lines += 1
+
+        pos = 0
+        comment = False
+        while True:
+            if self.quote is not None:
+                end_re = self._string_end_re[self.quote]
+                m = end_re.search(line, pos)
+                while m is not None and m.group().startswith('\\'):
+                    m = end_re.search(line, m.end())
+                if m is None:
+                    if len(self.quote) == 1 and not line.endswith('\\'):
+                        # an unterminated string; Python will complain
+                        self.quote = None
+                    break
+                pos = m.end()
+                self.quote = None
+            else:
+                m = self._code_re.search(line, pos)
+                if m is None:
+                    break
+                token = m.group()
+                pos = m.end()
+                if token == '#':
+                    comment = True
+                    break
+                elif token in '([{':
+                    self.depth += 1
+                elif token in ')]}':
+                    self.depth = max(self.depth - 1, 0)
+                else:
+                    self.quote = token
+        self.continued = (self.quote is None and not comment and line.endswith('\\'))
+
+def transform_name(f):
+    """Return a name for the input transform ``f``."""
+    return getattr(f, '__name__', None) or type(f).__name__
+
 def first_arg(f):
     def tm(arg1, arg2):
         return f(arg1)
+    tm.__name__ = transform_name(f)
     return tm
 
 class SageInputSplitter(IPythonInputSplitter):
@@ -184,6 +2591,14 @@ class SageInputSplitter(IPythonInputSplitter):
     1. to make the list of transforms a class attribute that can be modified
 
     2. to pass the line number to transforms (we strip the line number off for IPython transforms)
+
+    The results of the transforms are memoized in a bounded LRU cache,
+    keyed on the line, whether it is the first line, the settings of
+    the preparser, and any string literal it has seen opened on earlier
+    lines.  Transforms which keep state between lines are
+    listed in :attr:`stateful_transforms`; they and everything before
+    them always run.  Lines which can't be changed by the remaining
+    transforms, as checked by :attr:`prefilter_re`, skip them.
     """
 
         # List of input transforms to apply
@@ -191,8 +2606,162 @@ class SageInputSplitter(IPythonInputSplitter):
                                  transform_help_end, transform_escaped,
                                  transform_assign_system, transform_assign_magic])
 
+    # Types of the transforms whose result depends on previous lines
+    stateful_transforms = ()
+
+    # Maximum number of memoized transform results (0 disables the cache)
+    cache_size = 1000
+
+    # Whether to record, for each transform, the number of calls, their
+    # total and maximum time, and how many lines it changed
+    instrument = False
+
+    # Lines not matching this can't be changed by any of the Sage or
+    # IPython transforms, so they skip them.  Set it to None when adding
+    # transforms which may change other lines.
+    prefilter_re = re.compile(r"""[0-9%!?^\\]|\.\.|\.<|\)\s*=(?!=)|>>>|sage:"""
+                              r"""|^\s*([,;/]|(load|attach|time)\b)""")
+
+    def __init__(self, *args, **kwds):
+        self._block = BlockTracker()
+        super(SageInputSplitter, self).__init__(*args, **kwds)
+        self._transform_cache = OrderedDict()
+        self._preparser_state = None
+        self.reset_stats()
+
+    def transform_line(self, line, line_number):
+        """
+        Run ``line`` through :attr:`transforms`, using memoized results
+        where possible.
+        """
+        transforms = self.transforms
+        start = 0
+        for i, f in enumerate(transforms):
+            if isinstance(f, self.stateful_transforms):
+                start = i + 1
+        line = self._apply(transforms[:start], line, line_number)
+
+        # With implicit multiplication on, almost anything may change.
+        # The preparser also remembers open string literals from line
+        # to line, so lines which may change that have to go through
+        # it.  It forgets them on line 0, so do that here too, in case
+        # the line skips it.
+        state = preparser_state()
+        if line_number == 0:
+            import sage.misc.preparser
+            sage.misc.preparser.quote_state = None
+        quote_state = preparser_quote_state()
+        if self.prefilter_re is not None and not state[1]:
+            self.prefilter_checked += 1
+            if (quote_state is None and '"' not in line and "'" not in line
+                and self.prefilter_re.search(line) is None):
+                self.prefilter_skipped += 1
+                return line
+
+        if not self.cache_size:
+            return self._apply(transforms[start:], line, line_number)
+        if state != self._preparser_state:
+            self._transform_cache.clear()
+            self._preparser_state = state
+        cache = self._transform_cache
+        key = (line, line_number == 0, quote_state)
+        try:
+            result, quote_state = cache.pop(key)
+            self.cache_hits += 1
+            # Leave the preparser as preparsing the line would have.
+            import sage.misc.preparser
+            sage.misc.preparser.quote_state = quote_state
+        except KeyError:
+            result = self._apply(transforms[start:], line, line_number)
+            quote_state = preparser_quote_state()
+            self.cache_misses += 1
+            if len(cache) >= self.cache_size:
+                cache.popitem(last=False)
+        except TypeError:
+            # An unhashable quote state
+            return self._apply(transforms[start:], line, line_number)
+        cache[key] = (result, quote_state)
+        return result
+
+    def _apply(self, transforms, line, line_number):
+        if not self.instrument:
+            for f in transforms:
+                line = f(line, line_number)
+            return line
+        for f in transforms:
+            start = time.time()
+            out = f(line, line_number)
+            elapsed = time.time() - start
+            stats = self.transform_stats.get(transform_name(f))
+            if stats is None:
+                stats = self.transform_stats[transform_name(f)] = [0, 0.0, 0.0, 0]
+            stats[0] += 1
+            stats[1] += elapsed
+            stats[2] = max(stats[2], elapsed)
+            stats[3] += out != line
+            line = out
+        return line
+
+    def reset_stats(self):
+        """
+        Reset the transform, cache and prefilter counters.
+        """
+        self.transform_stats = OrderedDict()
+        self.cache_hits = self.cache_misses = 0
+        self.prefilter_checked = self.prefilter_skipped = 0
+
+    def prefilter_skip_rate(self):
+        """
+        Return the fraction of lines which skipped the transforms.
+        """
+        if not self.prefilter_checked:
+            return 0.0
+        return float(self.prefilter_skipped) / self.prefilter_checked
+
+    def reset(self):
+        super(SageInputSplitter, self).reset()
+        self._block.reset()
+
+    def _push_line(self, line):
+        """
+        Push a single line which is not the last of the input.
+
+        This has the same effect on the buffer, indentation and
+        completeness as the parent :meth:`push`, but only the current
+        top-level statement is compiled, and only when it isn't left
+        open in brackets, a string or a continuation.  Thus pushing
+        many lines takes time linear in their total length.  Once an
+        earlier statement failed to compile, the whole buffer never
+        compiles again, so the input is complete from then on.
+
+        The source is only joined and compiled as a whole by the
+        parent :meth:`push` of the last line.
+        """
+        block = self._block
+        self._buffer.append(line + '\n')
+        self.code, self._is_complete = None, None
+        if block.continued:
+            return False
+        self._update_indent(line)
+        if block.syntax_error:
+            self._is_complete = True
+        elif not block.at_boundary():
+            self._is_complete = False
+        else:
+            statement = u''.join(self._buffer[block.statement_start:])
+            try:
+                code = self._compile(statement, symbol="exec")
+            except (SyntaxError, OverflowError, ValueError, TypeError,
+                    MemoryError):
+                block.syntax_error = True
+                self._is_complete = True
+            else:
+                self._is_complete = code is not None
+        return self._is_complete
+
     # a direct copy of the IPython splitter, except that the
-    # transforms are called with the line numbers, and the transforms come from the class attribute
+    # transforms are called with the line numbers, and the transforms come from the class attribute.
+    # All lines but the last are pushed with _push_line, so long input is handled in linear time.
     def push(self, lines):
         """Push one or more lines of IPython input.
 
@@ -270,13 +2839,17 @@ class SageInputSplitter(IPythonInputSplitter):
         try:
             push = super(IPythonInputSplitter, self).push
             buf = self._buffer
-            for line in lines_list:
+            last = len(lines_list) - 1
+            for i, line in enumerate(lines_list):
                 line_number = len(buf)
                 if self._is_complete or not buf or \
                        (buf and buf[-1].rstrip().endswith((':', ','))):
-                    for f in self.transforms:
-                        line = f(line, line_number)
-                out = push(line)
+                    line = self.transform_line(line, line_number)
+                self._block.feed(line)
+                if i < last:
+                    out = self._push_line(line)
+                else:
+                    out = push(line)
         finally:
             if changed_input_mode:
                 self.input_mode = saved_input_mode
@@ -288,6 +2861,99 @@ class SageInputSplitter(IPythonInputSplitter):
 
 
 class SagePlugin(Plugin):
+    lazy_import = Bool(False, config=True, help="""
+        Fill the user namespace with proxies which import the functions,
+        classes and modules of sage.all_cmdline the first time they are
+        used, instead of importing sage.all_cmdline at startup.  Other
+        objects, such as QQ and pi, are still imported at startup, from
+        the modules defining them.""")
+    startup_profile = Bool(False, config=True, help="""
+        Print the time, CPU time, memory and imports of each phase of
+        startup.  Setting the SAGE_STARTUP_PROFILE environment variable
+        also turns this on.""")
+    startup_profile_file = Unicode(u'', config=True, help="""
+        File to dump the startup profile to as JSON.  A
+        SAGE_STARTUP_PROFILE environment variable ending in .json is
+        used as this file.""")
+    attach_watcher = CaselessStrEnum(['none', 'auto', 'inotify', 'poll'], 'none', config=True, help="""
+        How to notice changes to attached files.  With 'none' every
+        attached file is checked before each command.  Otherwise a
+        background thread collects the files which changed, using
+        inotify (which needs pyinotify) or by polling; 'auto' uses
+        inotify when it is available.""")
+    attach_poll_interval = Float(1.0, config=True, help="""
+        Seconds between checks of attached files when polling for
+        changes.""")
+    preparsed_cache_size = Int(50*1024*1024, config=True, help="""
+        Maximum size in bytes of the on-disk cache of preparsed and
+        compiled .sage files run by %load, %attach and the startup
+        file.  Set to 0 to disable the cache.""")
+    history_batch_cells = Int(100, config=True, help="""
+        When %iload runs many cells, write them to the history database
+        in transactions of this many cells.""")
+    history_batch_seconds = Float(5.0, config=True, help="""
+        When %iload runs many cells, write them to the history database
+        at least this often.""")
+    transform_cache_size = Int(1000, config=True, help="""
+        Number of input lines whose preparsed form is remembered, so
+        that repeated lines are not preparsed again.  Set to 0 to
+        disable the cache.""")
+    inspector_index = Bool(True, config=True, help="""
+        Remember the docstrings, sources and argspecs looked up by ?
+        and ?? in an index under DOT_SAGE, until the file they came
+        from changes.""")
+    prestart_interfaces = List([], config=True, help="""
+        Names of interfaces to other programs, such as 'gap' or
+        'maxima', to start just before the first prompt is shown, so
+        that they are ready when first used.  They are started one after
+        the other rather than in the background, which is safe for all
+        interfaces, but delays the first prompt.""")
+    fast_exit = Bool(False, config=True, help="""
+        When exiting, quit all the running interfaces to other programs
+        at the same time, killing those which take longer than
+        exit_timeout seconds, and skip the rest of Sage's cleanup,
+        which only frees memory.""")
+    exit_timeout = Float(2.0, config=True, help="""
+        Seconds to wait for interfaces to quit when fast_exit is on.""")
+    output_cache_count = Int(0, config=True, help="""
+        Keep at most this many results in the output history (Out and
+        _N); older results are replaced by a summary, or a weak
+        reference where possible.  Set to 0 for no limit.""")
+    output_cache_bytes = Int(0, config=True, help="""
+        Keep results estimated to take at most this many bytes in the
+        output history, evicting the least recently used ones.  Set to
+        0 for no limit.""")
+    memo_cache_size = Int(500*1024*1024, config=True, help="""
+        Maximum size in bytes of the on-disk cache of the variables
+        assigned by cells run with %%memo.  Set to 0 to disable it.""")
+    memory_tracking = Bool(False, config=True, help="""
+        After each cell, print how much the resident memory of Sage grew
+        and its peak while the cell ran; %memhistory shows them for all
+        the cells.  %memhistory on turns this on later.""")
+    memory_tracemalloc_top = Int(0, config=True, help="""
+        When tracking memory, also show the places in the code which
+        allocated the most memory in each cell, up to this many.  This
+        needs tracemalloc and slows down allocations.""")
+    completion_index = Bool(True, config=True, help="""
+        Complete global names from a sorted index built in the
+        background, and remember the attributes of the objects of each
+        type, so that tab completion doesn't scan the namespace or run
+        dir() on every TAB.""")
+    interactivity = CaselessStrEnum(['ipython', 'small', 'last_n'], 'ipython', config=True, help="""
+        Which results to display when ast_node_interactivity is 'all'.
+        With 'ipython' every expression is displayed; with 'small' only
+        results with at most interactivity_max_size entries, and the
+        result of the last statement; with 'last_n' only the results of
+        the last interactivity_last_n expressions.  A summary line says
+        how many results were not displayed.""")
+    interactivity_max_size = Int(100, config=True, help="""
+        The largest number of entries (matrix entries, list items and
+        so on) a result may have to be displayed when interactivity is
+        'small'.""")
+    interactivity_last_n = Int(1, config=True, help="""
+        The number of expressions at the end of a cell whose results
+        are displayed when interactivity is 'last_n'.""")
+
     startup_code = """from sage.all import *
 from sage.calculus.predefined import x
 from sage.misc.html import html
@@ -300,57 +2966,159 @@ from sagenb.misc.support import automatic_names
         self.shell = shell
         os.chdir(os.environ["CUR"])
 
-        self.auto_magics = SageMagics(shell)
-        shell.register_magics(self.auto_magics)
-        shell.magics_manager.register_alias('load','run')
-        shell.set_hook('pre_run_code_hook', self.auto_magics.pre_run_code_hook)
-        shell.display_formatter.formatters['text/plain'] = SagePlainTextFormatter(config=config)
-        from sage.misc.edit_module import edit_devel
-        self.shell.set_hook('editor', edit_devel)
-        self.init_inspector()
-        self.init_line_transforms()
-        self.set_quit_hook()
-        self.register_interface_magics()
-
-        self.print_branch()
-
-        # These are things I'm not sure that we need to do anymore
-        #self.deprecated()
-
-
-        if os.environ.get('SAGE_IMPORTALL', 'yes') != 'yes':
-            return
-
-        self.init_environment()
+        profile_env = os.environ.get('SAGE_STARTUP_PROFILE', '')
+        profile_file = self.startup_profile_file
+        if not profile_file and profile_env.endswith('.json'):
+            profile_file = profile_env
+        self.startup_profiler = StartupProfiler(self.startup_profile or bool(profile_env))
+        phase = self.startup_profiler.phase
+        try:
+            with phase('register_magics'):
+                self.auto_magics = SageMagics(shell)
+                self.auto_magics.watcher = make_attach_watcher(self.attach_watcher,
+                                                               self.attach_poll_interval)
+                shell.register_magics(self.auto_magics)
+                self.auto_magics.history_batch_cells = self.history_batch_cells
+                self.auto_magics.history_batch_seconds = self.history_batch_seconds
+                if self.preparsed_cache_size > 0:
+                    self.auto_magics.preparsed_cache = PreparsedFileCache(self.preparsed_cache_size)
+                shell.set_hook('pre_run_code_hook', self.auto_magics.pre_run_code_hook)
+                if self.output_cache_count > 0 or self.output_cache_bytes > 0:
+                    OutputCache.install(shell, self.output_cache_count, self.output_cache_bytes)
+                if self.memo_cache_size > 0:
+                    self.auto_magics.memo_cache = MemoCache(self.memo_cache_size)
+                if self.memory_tracking:
+                    self.auto_magics.enable_memory_tracking(self.memory_tracemalloc_top)
+                shell.display_formatter.formatters['text/plain'] = SagePlainTextFormatter(config=config)
+                from sage.misc.edit_module import edit_devel
+                self.shell.set_hook('editor', edit_devel)
+                if self.interactivity != 'ipython':
+                    shell.run_ast_nodes = InteractivityFilter(shell, self.interactivity,
+                                                              self.interactivity_last_n,
+                                                              self.interactivity_max_size)
+            with phase('init_inspector'):
+                self.init_inspector()
+            with phase('init_line_transforms'):
+                self.init_line_transforms()
+            with phase('set_quit_hook'):
+                self.set_quit_hook()
+            with phase('register_interface_magics'):
+                self.register_interface_magics()
+
+            with phase('print_branch'):
+                self.print_branch()
+
+            # These are things I'm not sure that we need to do anymore
+            #self.deprecated()
+
+
+            if os.environ.get('SAGE_IMPORTALL', 'yes') == 'yes':
+                with phase('init_environment'):
+                    self.init_environment()
+                with phase('run_init'):
+                    self.run_init()
+
+            with phase('init_completer'):
+                self.init_completer()
+        finally:
+            self.startup_profiler.report(profile_file)
 
     def register_interface_magics(self):
-        """Register magics for each of the Sage interfaces"""
-        interfaces = sorted([ obj.name()
-                              for obj in sage.interfaces.all.__dict__.values()
-                              if isinstance(obj, sage.interfaces.interface.Interface) ])
-        for name in interfaces:
+        """
+        Register magics for each of the Sage interfaces
+
+        The interfaces are read from a manifest, so registering the
+        magics doesn't import :mod:`sage.interfaces.all`.  It is
+        imported when one of the magics is first used, unless it was
+        already imported with the rest of the library (i.e., when
+        ``lazy_import`` is off), or to write the manifest the first
+        time this Sage library is started.
+        """
+        interfaces = load_manifest('interfaces')
+        if interfaces is None:
+            interfaces = interface_manifest()
+            save_manifest('interfaces', interfaces)
+        pool = self.auto_magics.interface_pool = InterfacePool(interfaces)
+        for name, attr in sorted(interfaces.items()):
             def tmp(line,name=name):
-                self.shell.run_cell('%s.interact()'%name)
+                pool.interface(name).interact()
             tmp.__doc__="Interact with %s"%name
             self.shell.register_magic_function(tmp, magic_name=name)
+        if self.prestart_interfaces:
+            def prestart(shell):
+                if not pool.prestarted:
+                    pool.prestarted = True
+                    pool.prestart(self.prestart_interfaces)
+                raise TryNext
+            self.shell.set_hook('pre_prompt_hook', prestart)
 
     def set_quit_hook(self):
         def quit(shell):
-            quit_sage()
+            if not self.fast_exit:
+                if 'sage.all' in sys.modules:
+                    from sage.all import quit_sage
+                    quit_sage()
+                elif 'sage.interfaces.quit' in sys.modules:
+                    # Only parts of the library were imported (lazily),
+                    # but some interfaces may be running.
+                    from sage.interfaces.quit import expect_quitall
+                    expect_quitall()
+                return
+            # The rest of quit_sage() only frees memory, which is about
+            # to happen anyway.
+            start = time.time()
+            report = quit_interfaces(self.exit_timeout)
+            if report:
+                killed = [name for name, seconds in report if seconds is None]
+                print 'Quit %d interfaces in %.3f s'%(len(report), time.time() - start)
+                if killed:
+                    print 'Killed after %g s: %s'%(self.exit_timeout, ', '.join(killed))
+                else:
+                    print 'Slowest: %s (%.3f s)'%report[0]
         self.shell.set_hook('shutdown_hook', quit)
 
     def print_branch(self):
-        from sage.misc.misc import branch_current_hg_notice, branch_current_hg
-        branch = branch_current_hg_notice(branch_current_hg())
-        if branch and self.test_shell is False:
-            print branch
+        """
+        Print a notice if the Sage library is not on its main branch.
+
+        The branch is cached along with the modification times of the
+        library's repository.  When those have changed, Mercurial is
+        asked in a background thread, so the prompt never waits for it
+        and the notice is printed when it is ready.
+        """
+        stamp = hg_branch_stamp()
+        cached = load_manifest('hg_branch')
+        if cached is not None and cached['stamp'] == stamp:
+            self.print_branch_notice(cached['branch'])
+            return
+        def lookup():
+            from sage.misc.misc import branch_current_hg
+            branch = branch_current_hg()
+            save_manifest('hg_branch', {'stamp': stamp, 'branch': branch})
+            self.print_branch_notice(branch)
+        thread = threading.Thread(target=lookup, name='print_branch')
+        thread.daemon = True
+        thread.start()
+
+    def print_branch_notice(self, branch):
+        from sage.misc.misc import branch_current_hg_notice
+        notice = branch_current_hg_notice(branch)
+        if notice and getattr(self, 'test_shell', False) is False:
+            print notice
 
     def init_environment(self):
         """
         Set up Sage command-line environment
         """
+        # Preparsed input needs Integer and RealNumber.  Without lazy
+        # imports, sage.all is imported here.
+        if self.lazy_import:
+            imports = ('from sage.rings.integer import Integer\n'
+                       'from sage.rings.real_mpfr import RealNumber')
+        else:
+            imports = 'from sage.all import Integer, RealNumber'
         try:
-            self.shell.run_cell('from sage.all import Integer, RealNumber')
+            self.shell.run_cell(imports)
         except Exception:
             import traceback
             print "Error importing the Sage library"
@@ -361,14 +3129,45 @@ from sagenb.misc.support import automatic_names
             print 'and then type "%debug" to enter the interactive debugger'
             sys.exit(1)
 
-        self.shell.run_cell('from sage.all_cmdline import *')
-        self.run_init()
+        if self.lazy_import:
+            self.init_lazy_namespace()
+        else:
+            self.shell.run_cell('from sage.all_cmdline import *')
+
+    def init_lazy_namespace(self):
+        """
+        Put a lazy import of each function, class and module of
+        :mod:`sage.all_cmdline` into the user namespace, and import its
+        other objects from the modules defining them.
+
+        The names come from a manifest written the first time we start
+        with this Sage library; until it exists, we import everything.
+        """
+        manifest = load_manifest('all_cmdline')
+        if not isinstance(manifest, dict) or 'lazy' not in manifest:
+            self.shell.run_cell('from sage.all_cmdline import *')
+            save_manifest('all_cmdline', all_cmdline_manifest())
+            return
+        import importlib
+        from sage.misc.lazy_import import LazyImport
+        ns = self.shell.user_ns
+        eager = {}
+        for name, module in manifest['eager'].iteritems():
+            if name not in ns:
+                eager.setdefault(module, []).append(name)
+        for module, names in sorted(eager.iteritems()):
+            module = importlib.import_module(module)
+            for name in names:
+                ns[name] = getattr(module, name)
+        for name, module in manifest['lazy'].iteritems():
+            if name not in ns:
+                ns[name] = LazyImport(module, name, namespace=ns)
 
 
     def run_init(self):
         startup_file = os.environ.get('SAGE_STARTUP_FILE', '')
         if os.path.exists(startup_file):
-            self.shell.run_cell('%%run "%s"'%startup_file)
+            self.auto_magics.load_file(startup_file)
 
     def init_inspector(self):
         # Ideally, these would just be methods of the Inspector class
@@ -377,20 +3176,45 @@ from sagenb.misc.support import automatic_names
         # Thus, we have to monkey-patch.
         from sage.misc import sagedoc, sageinspect
         import IPython.core.oinspect
-        IPython.core.oinspect.getdoc = sageinspect.sage_getdoc #sagedoc.my_getdoc
-        IPython.core.oinspect.getsource = sagedoc.my_getsource
-        IPython.core.oinspect.getargspec = sageinspect.sage_getargspec
+        getdoc = sageinspect.sage_getdoc #sagedoc.my_getdoc
+        getsource = sagedoc.my_getsource
+        getargspec = sageinspect.sage_getargspec
+        index = None
+        if self.inspector_index:
+            try:
+                index = InspectorIndex(os.path.join(sage_cache_dir(), 'inspector.sqlite'))
+            except OSError:
+                # DOT_SAGE can't be written to.
+                pass
+        if index is not None:
+            getdoc = index.cached('doc', getdoc)
+            getsource = index.cached('source', getsource)
+            getargspec = index.cached('argspec', getargspec)
+        IPython.core.oinspect.getdoc = getdoc
+        IPython.core.oinspect.getsource = getsource
+        IPython.core.oinspect.getargspec = getargspec
+
+    def init_completer(self):
+        if not self.completion_index:
+            return
+        from IPython.core import completer
+        index = CompletionIndex(self.shell)
+        self.shell.Completer.global_matches = index.global_matches
+        completer.dir2 = index.dir2
+        self.shell.register_post_execute(index.post_execute)
+        index.start()
 
     def init_line_transforms(self):
         self.shell.input_splitter = SageInputSplitter()
-        import sage
-        import sage.all
         from sage.misc.interpreter import (SagePromptDedenter, SagePromptTransformer,
-                                           LoadAttachTransformer, SagePreparseTransformer)
+                                           LoadAttachTransformer, SagePreparseTransformer,
+                                           preparser)
         self.shell.input_splitter.transforms = [SagePromptDedenter(),
                                                 SagePromptTransformer(),
                                                 LoadAttachTransformer(),
                                                 SagePreparseTransformer()] + self.shell.input_splitter.transforms
+        self.shell.input_splitter.stateful_transforms = (SagePromptDedenter,)
+        self.shell.input_splitter.cache_size = self.transform_cache_size
 
         preparser(True)
 
@@ -476,3 +476,112 @@ c.PromptManager.in_template = 'sage: '
 # Only necessary for items in script_magics where the default path will not find
 # the right interpreter.
 # c.ScriptMagics.script_paths = {}
+
+#------------------------------------------------------------------------------
+# SagePlugin configuration
+#------------------------------------------------------------------------------
+
+# Fill the user namespace with proxies which import the functions, classes and
+# modules of sage.all_cmdline the first time they are used, instead of
+# importing sage.all_cmdline at startup.  Other objects, such as QQ and pi,
+# are still imported at startup, from the modules defining them.
+# c.SagePlugin.lazy_import = False
+
+# Print the time, CPU time, memory and imports of each phase of startup.
+# Setting the SAGE_STARTUP_PROFILE environment variable also turns this on.
+# c.SagePlugin.startup_profile = False
+
+# File to dump the startup profile to as JSON.  A SAGE_STARTUP_PROFILE
+# environment variable ending in .json is used as this file.
+# c.SagePlugin.startup_profile_file = u''
+
+# How to notice changes to attached files.  With 'none' every attached file
+# is checked before each command.  Otherwise a background thread collects the
+# files which changed, using inotify (which needs pyinotify) or by polling;
+# 'auto' uses inotify when it is available.
+# c.SagePlugin.attach_watcher = 'none'
+
+# Seconds between checks of attached files when polling for changes.
+# c.SagePlugin.attach_poll_interval = 1.0
+
+# Maximum size in bytes of the on-disk cache of preparsed and compiled .sage
+# files run by %load, %attach and the startup file.  Set to 0 to disable the
+# cache.
+# c.SagePlugin.preparsed_cache_size = 52428800
+
+# Number of input lines whose preparsed form is remembered, so that repeated
+# lines are not preparsed again.  Set to 0 to disable the cache.
+# c.SagePlugin.transform_cache_size = 1000
+
+# Remember the docstrings, sources and argspecs looked up by ? and ?? in an
+# index under DOT_SAGE, until the file they came from changes.
+# c.SagePlugin.inspector_index = True
+
+# Complete global names from a sorted index built in the background, and
+# remember the attributes of the objects of each type, so that tab completion
+# doesn't scan the namespace or run dir() on every TAB.
+# c.SagePlugin.completion_index = True
+
+# Names of interfaces to other programs, such as 'gap' or 'maxima', to start
+# just before the first prompt is shown, so that they are ready when first
+# used.  They are started one after the other rather than in the background,
+# which is safe for all interfaces, but delays the first prompt.
+# %interfaces shows how they are doing.
+# c.SagePlugin.prestart_interfaces = []
+
+# When exiting, quit all the running interfaces to other programs at the same
+# time, killing those which take longer than exit_timeout seconds, and skip
+# the rest of Sage's cleanup, which only frees memory.
+# c.SagePlugin.fast_exit = False
+# c.SagePlugin.exit_timeout = 2.0
+
+# After each cell, print how much the resident memory of Sage grew and its
+# peak while the cell ran; %memhistory shows them for all the cells.  With
+# memory_tracemalloc_top, also show the places in the code which allocated the
+# most memory (this needs tracemalloc).
+# c.SagePlugin.memory_tracking = False
+# c.SagePlugin.memory_tracemalloc_top = 0
+
+# Limits on the results kept in the output history (Out and _N): at most
+# output_cache_count results, estimated to take at most output_cache_bytes
+# bytes.  The least recently used results are replaced by a summary, or a
+# weak reference where possible.  0 means no limit.
+# c.SagePlugin.output_cache_count = 0
+# c.SagePlugin.output_cache_bytes = 0
+
+# Maximum size in bytes of the on-disk cache of the variables assigned by
+# cells run with %%memo.  Set to 0 to disable it.
+# c.SagePlugin.memo_cache_size = 524288000
+
+# When %iload runs many cells, write them to the history database in
+# transactions of this many cells, and at least every history_batch_seconds.
+# c.SagePlugin.history_batch_cells = 100
+# c.SagePlugin.history_batch_seconds = 5.0
+
+# Which results to display when ast_node_interactivity is 'all'.  With
+# 'ipython' every expression is displayed; with 'small' only results with at
+# most interactivity_max_size entries, and the result of the last statement;
+# with 'last_n' only the results of the last interactivity_last_n
+# expressions.  A summary line says how many results were not displayed.
+# c.SagePlugin.interactivity = 'ipython'
+# c.SagePlugin.interactivity_max_size = 100
+# c.SagePlugin.interactivity_last_n = 1
+
+#------------------------------------------------------------------------------
+# SagePlainTextFormatter configuration
+#------------------------------------------------------------------------------
+
+# Limits on how much of a result is displayed.  Matrices are cut down to
+# max_rows rows and max_cols columns, lists, tuples, dictionaries and sets to
+# max_rows entries, polynomials to max_cols terms and strings to max_chars
+# characters before they are formatted.  Other objects are formatted in full,
+# and output longer than max_chars characters is then cut off.  A note says
+# what was left out.  0 means no limit.
+# c.SagePlainTextFormatter.max_chars = 0
+# c.SagePlainTextFormatter.max_rows = 0
+# c.SagePlainTextFormatter.max_cols = 0
+
+# Maximum number of seconds to spend formatting a result.  If it takes
+# longer, a short summary of the object's type and size is displayed instead,
+# and %show_full _ displays it in full.  0 means no limit.
+# c.SagePlainTextFormatter.timeout = 0.0